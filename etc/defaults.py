@@ -39,6 +39,47 @@ dbdir = 'var/db'
 datafsname = 'Data.fs'
 datafs = '%s/%s' % (dbdir, datafsname)
 backupdir = 'var/db/backup'
+incbackupdir = 'var/db/incbackup' # incremental backups. See src/backup.py
+
+# 'file' opens datafs directly. Only one process can use the database.
+# 'zeo' connects through a ZEO server (started by tzcontrol.py) so that
+#   the web interface and the tools in db.py can run beside the server.
+storage = 'file'
+runzeo = '/usr/bin/runzeo'
+zeo_address = ('127.0.0.1', 4445)
+zeolog = 'var/log/zeo.log'
+zeopid = 'var/run/zeo.pid'
+conflict_retries = 3 # times to re-run a command after a ConflictError.
+conflict_backoff = 0.05 # seconds to wait before the first re-run. Doubles
+                        #   for each following attempt.
+
+cache_size = 5000 # number of objects to keep loaded per connection.
+cache_size_bytes = 0 # approximate memory limit for the cache. 0 for none.
+pool_size = 7 # connections before a warning about too many connections.
+
+pack_interval = 600 # seconds between packs of the running DB. 0 to disable.
+pack_days = 0 # keep this many days of old object revisions when packing.
+
+tzid_block = 1000 # number of object id numbers to reserve at a time.
+upgrade_batch = 500 # objects upgraded per transaction by share.upgradeall()
+
+scheduler_tick = 0.1 # seconds between runs of the mob/room scheduler.
+scheduler_slots = 1024 # slots in the scheduler timer wheel.
+scheduler_horizon = 10 # seconds ahead to read scheduled calls from the DB.
+scheduler_load = 1000 # most scheduled calls to read from the DB per tick.
+scheduler_rescan = 60 # seconds between reading the whole schedule again.
+sim_overload_lag = 0.5 # seconds late a tick can be before the server is
+                        #   considered overloaded.
+sim_budget = 0.05 # seconds a tick can take before the server is overloaded.
+sim_shed_priority = 1 # rooms with lower sim_priority are put off when
+                        #   overloaded. 0 to never put any off.
+sim_shed_delay = 30 # seconds to put off a room when overloaded.
+sim_shed_max = 300 # seconds a room can be put off before it runs anyway.
+spread_max_rooms = 1000 # most rooms a shout (or other spreading action)
+                        #   can reach.
+aoi_radius = 3 # mobs more than this many exits from any player go dormant.
+                #   0 to keep all mobs acting all the time.
+aoi_catch_up = 5 # most actions a dormant mob takes to catch up on waking.
 
 port = 4444
 local_only = True
@@ -870,7 +870,7 @@ def cmd_quit(s, r=None):
 
     '''
 
-    s.transport.loseConnection()
+    s.disconnect()
 
 
 def cmd_who(s, r=None):
@@ -37,15 +37,14 @@ import players
 import rooms
 import mobs
 import wizard
+import backup
+from scheduler import TZScheduler
 
 
 def verify(player):
-    'Return True if player is a wizard, False otherwise.'
+    'Return True if player is an admin, False otherwise.'
 
-    if player.name in dbroot['admin']:
-        return True
-    else:
-        return False
+    return 'admin' in getattr(player, '_roles', ())
 
 
 def add(player):
@@ -53,6 +52,7 @@ def add(player):
 
     if not verify(player):
         dbroot['admin'].append(player.name)
+        player.add_role('admin')
 
 
 def cmd_admin(s, r):
@@ -158,6 +158,54 @@ def cmd_db(s, r=None):
         s.message('')
 
 
+def cmd_cache(s):
+    '''cache
+
+    Show statistics for the database object cache. Loads are objects
+        that had to be read from storage because they were not in the
+        cache. They are counted since the last time this command was
+        used.
+
+    '''
+
+    stats = TZODB().cache_stats()
+
+    s.message('Objects in cache: %(size)s (target %(target)s)' % stats)
+    s.message('Loaded: %(active)s  Ghosts: %(ghosts)s' % stats)
+    if stats['target_bytes']:
+        s.message('Estimated bytes: %(bytes)s (target %(target_bytes)s)'
+                                                                    % stats)
+    else:
+        s.message('Estimated bytes: %(bytes)s' % stats)
+    s.message('Storage reads: %(loads)s in %(seconds).1f seconds' % stats)
+    s.message('Loads per second: %(loads_per_second).2f' % stats)
+    s.message('Storage writes: %(stores)s' % stats)
+
+
+def cmd_scheduler(s):
+    '''scheduler
+
+    Show statistics for the scheduler which runs mob actions and
+        periodic room code. Lag is how late the last tick ran.
+
+    '''
+
+    stats = TZScheduler().stats()
+
+    if not stats['running']:
+        s.message('Scheduler is not running.')
+    s.message('Waiting: %(queued)s  In database: %(stored)s' % stats)
+    s.message('Read from database: %(loads)s  Rescans: %(rescans)s' % stats)
+    s.message('Observed rooms: %(observed)s  Dormant mobs: %(dormant)s'
+                                                                % stats)
+    s.message('Tick: %(tick)s seconds  Slots: %(slots)s' % stats)
+    s.message('Ticks: %(ticks)s  Calls: %(fired)s  Errors: %(errors)s'
+                                                                % stats)
+    s.message('Last batch: %(last_batch)s  Largest: %(max_batch)s' % stats)
+    s.message('Lag: %(lag).3f seconds  Most: %(max_lag).3f seconds' % stats)
+    s.message('Rooms simulated: %(simulated)s  Put off: %(shed)s' % stats)
+
+
 def cmd_pack(s):
     '''pack
 
@@ -165,24 +213,66 @@ def cmd_pack(s):
 
     '''
 
-    s.message('Packing database.')
-    TZODB().pack()
-    s.message('Database Packed.')
+    if TZODB().pack_background():
+        s.message('Packing database.')
+        s.message('Use the packstatus command to check on progress.')
+    else:
+        s.message('Database is already being packed.')
+
+
+def cmd_packstatus(s):
+    '''packstatus
+
+    Show the progress of the current database pack, or the results
+        of the last one.
+
+    '''
+
+    zodb = TZODB()
+    duration = zodb.pack_duration()
+    if duration is None:
+        s.message('Database has not been packed since the server started.')
+    elif zodb.packing:
+        s.message('Packing for %.1f seconds.' % duration)
+        written = zodb.pack_progress()
+        if written is not None:
+            s.message('%s of %s bytes written.' % (written,
+                                                    zodb.pack_size_before))
+    elif zodb.pack_error is not None:
+        s.message('Last pack failed after %.1f seconds.' % duration)
+        s.message(zodb.pack_error)
+    else:
+        s.message('Last pack took %.1f seconds.' % duration)
+        s.message('Size before: %s bytes' % zodb.pack_size_before)
+        s.message('Size after: %s bytes' % zodb.pack_size_after)
 
 
-def cmd_backup(s):
-    '''backup
+def cmd_backup(s, r=None):
+    '''backup [full]
 
     Create a backup of the database. The name of the backup file is
         based on the date and time. The database can later be rolled
         back to this file using the rollback command.
 
+    Only the changes made since the last backup are saved, unless
+        "full" is given, or the database has been packed since then.
+        The backup runs in the background.
+
     '''
 
-    cmd = '%s %s -b' % (conf.python, conf.tzcontrol)
-    os.system(cmd)
+    def done(name, error):
+        if error is not None:
+            s.message('Backup failed:', error)
+        elif name is None:
+            s.message('Nothing has changed since the last backup.')
+        else:
+            s.message('Backup', name, 'saved.')
 
-    s.message('Backup saved.')
+    full = r == 'full'
+    if backup.backup_background(done, full):
+        s.message('Backing up database.')
+    else:
+        s.message('A backup or pack is already running. Try again later.')
 
 
 def cmd_restart(s, r=None):
@@ -313,6 +403,11 @@ def cmd_list(s, r):
             s.mlmessage(backups, indent=4)
         else:
             s.message('No backups yet.')
+
+        incbackups = backup.ls()
+        if incbackups:
+            s.message('Incremental backups:')
+            s.mlmessage(incbackups, indent=4)
     else:
         s.message('Not implemented.')
 
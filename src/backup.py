@@ -0,0 +1,362 @@
+# Copyright 2008 Lee Harr
+#
+# This file is part of TZMud.
+#
+# TZMud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TZMud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TZMud.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Incremental backups of the database, in the style of repozo.
+
+A FileStorage only ever adds transactions to the end of Data.fs (until
+    it is packed) so a backup does not need to copy the whole file
+    every time. The first backup is a full copy of Data.fs up to the
+    end of the last committed transaction. Each following backup only
+    copies the transactions added since the one before.
+
+The backups are kept in conf.incbackupdir:
+
+    <stamp>.fs       full backup
+    <stamp>.deltafs  transactions added since the previous backup
+    <stamp>.dat      index for the chain of backups starting with the
+                        full backup of the same name. One line for each
+                        file in the chain: name, start, end, md5, tid
+
+Packing rewrites Data.fs, so the next backup after a pack is always
+    a full backup.
+
+To restore, the files in the chain are joined together in order.
+
+'''
+
+
+import os
+import time
+import hashlib
+from binascii import hexlify
+
+import conf
+
+
+BLOCKSIZE = 1 << 16
+
+
+class TZBackup(object):
+    'State of the backups. A Borg object with shared state.'
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self):
+        if not hasattr(self, 'running'):
+            self.running = False
+            self.last = None
+            self.last_error = None
+            self.last_pack = None
+
+
+def stamp(*exts):
+    '''Return a string based on the current time to use as a file name.
+
+    If there is already a backup file with that name and one of the
+        given extensions (from an earlier backup in the same second) a
+        number is added to the end to make it unique. The names still
+        sort in the order they were made.
+
+    '''
+
+    base = time.strftime('%Y-%m-%d-%H-%M-%S', time.gmtime())
+    s = base
+    n = 0
+    while [ext for ext in exts if os.path.exists(
+                        os.path.join(conf.incbackupdir, '%s.%s' % (s, ext)))]:
+        n += 1
+        s = '%s_%03d' % (base, n)
+    return s
+
+def dats():
+    'Return a sorted list of the paths of all of the backup index files.'
+
+    if not os.path.exists(conf.incbackupdir):
+        return []
+    names = [f for f in os.listdir(conf.incbackupdir) if f.endswith('.dat')]
+    names.sort()
+    return [os.path.join(conf.incbackupdir, f) for f in names]
+
+def read_dat(path):
+    '''Return the list of backup files in the given index file.
+
+    Each entry is a tuple (name, start, end, md5, tid)
+
+    '''
+
+    entries = []
+    for line in file(path):
+        parts = line.split()
+        if len(parts) != 5:
+            continue
+        name, start, end, md5, tid = parts
+        entries.append((name, int(start), int(end), md5, tid))
+    return entries
+
+def ls():
+    'Return a list of the names of all backup files, oldest first.'
+
+    names = []
+    for path in dats():
+        for entry in read_dat(path):
+            names.append(entry[0])
+    return names
+
+def isbackup(name):
+    'Return True if name is the name of an incremental backup file.'
+
+    return os.path.basename(name) in ls()
+
+def chunk_md5(path, start, end):
+    'Return the md5 of bytes start to end of the file at path.'
+
+    md5 = hashlib.md5()
+    f = file(path, 'rb')
+    try:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(BLOCKSIZE, remaining))
+            if not data:
+                break
+            md5.update(data)
+            remaining -= len(data)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+def copy_chunk(src, dest, start, end):
+    '''Copy bytes start to end of the file at src to a new file at dest.
+
+    Returns the md5 of the bytes copied.
+
+    '''
+
+    if os.path.exists(dest):
+        raise IOError, 'Backup file %s already exists.' % dest
+
+    md5 = hashlib.md5()
+    fin = file(src, 'rb')
+    fout = file(dest, 'wb')
+    try:
+        fin.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = fin.read(min(BLOCKSIZE, remaining))
+            if not data:
+                raise IOError, 'Database file is shorter than expected.'
+            fout.write(data)
+            md5.update(data)
+            remaining -= len(data)
+    finally:
+        fin.close()
+        fout.close()
+    return md5.hexdigest()
+
+def position():
+    '''Return (pos, tid) for the database.
+
+    pos is the end of the last committed transaction in Data.fs and tid
+        is the id of that transaction. Everything in the file before pos
+        will not change until the database is packed.
+
+    If this process has Data.fs open (the running server) the numbers
+        come from the open storage, otherwise Data.fs is opened read
+        only just long enough to find them.
+
+    '''
+
+    from ZODB import FileStorage
+
+    storage = None
+    if conf.storage == 'file':
+        import db
+        storage = db.TZODB._state.get('storage')
+        fname = getattr(storage, '_file_name', None)
+        if fname is None or (os.path.abspath(fname) !=
+                                os.path.abspath(conf.datafs)):
+            storage = None
+
+    if storage is not None:
+        storage._lock_acquire()
+        try:
+            return storage._pos, storage.lastTransaction()
+        finally:
+            storage._lock_release()
+    else:
+        fs = FileStorage.FileStorage(conf.datafs, read_only=True)
+        try:
+            return fs._pos, fs.lastTransaction()
+        finally:
+            fs.close()
+
+def backup(full=False):
+    '''Back up the database and return the name of the new backup file.
+
+    Makes an incremental backup if possible, or a full backup if there
+        is no earlier backup, if the database has been packed since
+        then, or if full is True.
+
+    Returns None if nothing has changed since the last backup.
+
+    '''
+
+    if not os.path.exists(conf.incbackupdir):
+        os.mkdir(conf.incbackupdir)
+
+    pos, tid = position()
+    tid = hexlify(tid)
+
+    paths = dats()
+    entries = []
+    if paths and not full:
+        datpath = paths[-1]
+        entries = read_dat(datpath)
+
+    if entries:
+        name, start, end, md5, lasttid = entries[-1]
+        if pos < end or chunk_md5(conf.datafs, start, end) != md5:
+            # Data.fs has been packed (or replaced)
+            entries = []
+        elif pos == end:
+            return None
+
+    if not entries:
+        s = stamp('fs', 'dat')
+        name = '%s.fs' % s
+        datpath = os.path.join(conf.incbackupdir, '%s.dat' % s)
+        start = 0
+    else:
+        name = '%s.deltafs' % stamp('deltafs')
+        start = entries[-1][2]
+
+    dest = os.path.join(conf.incbackupdir, name)
+    md5 = copy_chunk(conf.datafs, dest, start, pos)
+
+    f = file(datpath, 'a')
+    f.write('%s %s %s %s %s\n' % (name, start, pos, md5, tid))
+    f.close()
+
+    return name
+
+def backup_background(callback=None, full=False):
+    '''Run backup() in a worker thread so that the reactor keeps running.
+
+    When the backup is done, calls callback(name, error) where name is
+        the name of the new backup file (or None if nothing changed) and
+        error is None or the error message if the backup failed.
+
+    Returns False without doing anything if a backup or a pack is
+        already running.
+
+    '''
+
+    from twisted.internet import threads
+    import db
+
+    state = TZBackup()
+    zodb = db.TZODB()
+    if state.running or zodb.packing:
+        return False
+
+    if zodb.pack_finished is not None and zodb.pack_finished != state.last_pack:
+        # Data.fs was packed since the last backup
+        full = True
+        state.last_pack = zodb.pack_finished
+
+    state.running = True
+
+    def done(name):
+        state.running = False
+        state.last = time.time()
+        state.last_error = None
+        if callback is not None:
+            callback(name, None)
+
+    def failed(failure):
+        state.running = False
+        state.last_error = failure.getErrorMessage()
+        print 'Backup failed:', state.last_error
+        if callback is not None:
+            callback(None, state.last_error)
+
+    d = threads.deferToThread(backup, full)
+    d.addCallbacks(done, failed)
+
+    return True
+
+def running():
+    'Return True if a backup is running right now.'
+
+    return TZBackup().running
+
+def restore(name, dest):
+    '''Rebuild the database at dest from the backups, up to and
+        including the backup file with the given name.
+
+    The md5 of each file is checked along the way, and the restored
+        database is opened to make sure that it ends with the same
+        transaction as the backup.
+
+    '''
+
+    from ZODB import FileStorage
+
+    name = os.path.basename(name)
+    for path in dats():
+        entries = read_dat(path)
+        names = [entry[0] for entry in entries]
+        if name in names:
+            break
+    else:
+        raise ValueError, 'No backup named %s' % name
+
+    entries = entries[:names.index(name)+1]
+
+    out = file(dest, 'wb')
+    try:
+        for fname, start, end, md5, tid in entries:
+            print 'Restoring', fname
+            src = os.path.join(conf.incbackupdir, fname)
+            check = hashlib.md5()
+            f = file(src, 'rb')
+            try:
+                while True:
+                    data = f.read(BLOCKSIZE)
+                    if not data:
+                        break
+                    out.write(data)
+                    check.update(data)
+            finally:
+                f.close()
+            if check.hexdigest() != md5:
+                raise IOError, 'Backup file %s is damaged.' % fname
+    finally:
+        out.close()
+
+    fs = FileStorage.FileStorage(dest, read_only=True)
+    try:
+        lasttid = hexlify(fs.lastTransaction())
+    finally:
+        fs.close()
+    if lasttid != tid:
+        raise IOError, 'Restored database does not end at the right place.'
@@ -0,0 +1,272 @@
+# Copyright 2008 Lee Harr
+#
+# This file is part of TZMud.
+#
+# TZMud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TZMud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TZMud.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Benchmarks for parts of the server which need to be fast.
+
+Run from the main tzmud directory:
+
+    python src/bench.py [<name> ...]
+
+With no names, runs all of the benchmarks. The benchmarks run in a
+    scratch database made in a temporary directory and removed at the
+    end, so the MUD database is not touched (and the server can keep
+    running). Each benchmark builds what it needs, and anything it
+    does not commit is aborted at the end.
+
+'''
+
+
+import os
+import sys
+import time
+
+if __name__ == '__main__':
+    etc = os.path.abspath('etc')
+    sys.path.append(etc)
+    src = os.path.abspath('src')
+    sys.path.append(src)
+
+    import conf
+    conf.load_plugins = False
+
+    import tempfile
+    scratch = tempfile.mkdtemp(prefix='tzbench')
+    conf.storage = 'file'
+    conf.datafs = os.path.join(scratch, 'Data.fs')
+    conf.pack_interval = 0
+
+
+def timeit(label, func, n):
+    'Call func() n times and print how long each call took.'
+
+    start = time.time()
+    for i in xrange(n):
+        func()
+    elapsed = time.time() - start
+    print '    %-30s %8.2f usec' % (label, elapsed / n * 1e6)
+    return elapsed
+
+
+def bench_chain(depth=6, n=20000):
+    '''Finding the room and the containers of an item nested depth
+        levels deep in bags.
+
+    Compares the cached container chain (TZObj._chain) with walking up
+        the containers one by one, as .room and .containers() did
+        before the chain was cached.
+
+    '''
+
+    import share
+    import rooms
+    import items
+    tzindex = share.tzindex
+
+    def walk_room(obj):
+        container = tzindex.get(obj._containerid)
+        if container is None:
+            return None
+        elif walk_room(container) is None:
+            return container
+        else:
+            return walk_room(container)
+
+    def walk_containers(obj):
+        container = tzindex.get(obj._containerid)
+        if container is None:
+            return ()
+        else:
+            return (container,) + walk_containers(container)
+
+    room = rooms.Room('bench room')
+    container = room
+    for i in range(depth):
+        bag = items.Bag()
+        container.add(bag)
+        container = bag
+    rose = items.Rose()
+    container.add(rose)
+
+    assert rose.room is room
+    assert walk_room(rose) is room
+    assert rose.containers() == walk_containers(rose)
+
+    print 'item in %s nested bags, %s calls' % (depth, n)
+    timeit('room (walk)', lambda: walk_room(rose), n)
+    timeit('room (cached)', lambda: rose.room, n)
+    timeit('containers() (walk)', lambda: walk_containers(rose), n)
+    timeit('containers() (cached)', lambda: rose.containers(), n)
+
+    # moving the outermost bag invalidates every chain below it
+    outer = room.items()[0]
+    def move():
+        room.remove(outer)
+        room.add(outer)
+        return rose.room
+    timeit('move outer bag + room', move, n/10)
+
+
+def bench_actions(n=10000):
+    '''Choosing the next action for n mobs, once each, as one tick
+        of the scheduler would.
+
+    Compares Mob.action() (action names from the class, cached
+        weights) with finding the action methods with dir() and
+        working out the weights every time, as it was done before.
+
+    '''
+
+    import random
+    from bisect import bisect
+    import mobs
+
+    def uncached_action(mob):
+        action_names = [meth_name for meth_name in dir(mob)
+                            if meth_name.startswith('action_')]
+        weights = [mob._action_weights[meth_name]
+                            for meth_name in action_names]
+        total = float(sum(weights))
+        cum_norm_weights = [0.0]*len(weights)
+        for i in xrange(len(weights)):
+            cum_norm_weights[i] = cum_norm_weights[i-1] + weights[i]/total
+        meth_name = action_names[bisect(cum_norm_weights, random.random())]
+        return getattr(mob, meth_name)
+
+    classes = [mobs.Cat, mobs.Sloth, mobs.Snake, mobs.PackRat]
+    herd = [classes[i % len(classes)]() for i in xrange(n)]
+
+    # make sure the caches are built before timing
+    for mob in herd:
+        mob.action()
+
+    print '%s mobs, one action choice each' % n
+    tu = timeit('dir() + weights (uncached)',
+                    lambda: [uncached_action(mob) for mob in herd], 1)
+    tc = timeit('Mob.action() (cached)',
+                    lambda: [mob.action() for mob in herd], 1)
+    print '    %.1fx faster' % (tu / tc)
+
+
+def bench_shout(size=100, n=20):
+    '''A shout spreading through a size x size grid of rooms.
+
+    Every pair of neighbouring rooms is joined both ways, so there are
+        loops all through the grid.
+
+    Compares Room._spread (breadth first, each room once) with the
+        recursive spread used before, which went back through the
+        same rooms over and over by going around the loops, scanned
+        all of the exits of each room to find the way back, and made
+        a savepoint for every room. The old way is only timed for
+        short shouts since its cost grows exponentially.
+
+    The grid is committed before timing, so a savepoint only has to
+        save what the shout itself changed.
+
+    '''
+
+    import transaction
+    import share
+    import conf
+    import rooms
+    import exits
+    zodb = share.zodb
+
+    grid = []
+    for row in xrange(size):
+        line = []
+        for col in xrange(size):
+            room = rooms.Room('bench %s %s' % (row, col))
+            line.append(room)
+            if col:
+                exits.Exit('east', room=line[col-1], destination=room,
+                                return_name='west')
+            if row:
+                exits.Exit('south', room=grid[row-1][col], destination=room,
+                                return_name='north')
+        grid.append(line)
+        if row % 10 == 9:
+            zodb.commit()
+    zodb.commit()
+    center = grid[size/2][size/2]
+    assert len(center.exits()) == 4
+    for x in center.exits():
+        assert x.destination.exitto(center) is not None
+
+    def old_action(room, info):
+        transaction.savepoint(True)
+        room.act_near(info)
+        spread = info.get('spread', None)
+        if spread is not None and spread > 0:
+            fromroom = info.get('fromroom', None)
+            info['fromroom'] = room
+            info['spread'] -= 1
+            for x in room.exits():
+                dest = x.destination
+                if dest == fromroom:
+                    continue
+                for bx in dest.exits():
+                    if bx.destination == room:
+                        info['fromx'] = bx
+                        break
+                old_action(dest, info)
+
+    def shout(spread):
+        return dict(act='shout', actor=None, raw='bench', spread=spread)
+
+    print '%s rooms, shout from the middle, %s shouts each' % (size*size, n)
+    for spread in 2, 4, 6:
+        timeit('spread %s (recursive)' % spread,
+                    lambda: old_action(center, shout(spread)), n)
+        timeit('spread %s (breadth first)' % spread,
+                    lambda: center._spread(shout(spread)), n)
+    for spread in 20, size:
+        timeit('spread %s (breadth first)' % spread,
+                    lambda: center._spread(shout(spread)), n)
+    print '    (at most %s rooms per shout)' % conf.spread_max_rooms
+
+
+benchmarks = [
+    ('chain', bench_chain),
+    ('actions', bench_actions),
+    ('shout', bench_shout),
+]
+
+
+def main(names):
+    import db
+    zodb = db.TZODB()
+    db.db_init_tables()
+
+    for name, bench in benchmarks:
+        if names and name not in names:
+            continue
+        try:
+            bench()
+        finally:
+            zodb.abort()
+
+
+if __name__ == '__main__':
+    import shutil
+    try:
+        main(sys.argv[1:])
+    finally:
+        import db
+        db.TZODB().close()
+        shutil.rmtree(scratch)
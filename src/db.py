@@ -23,12 +23,17 @@ probably only be done after deleting any current database first.
 
 '''
 
-DB_VERSION = 4
+DB_VERSION = 11
 
 from ZODB import FileStorage, DB, serialize
+from ZODB.POSException import ConflictError
 import transaction
 from persistent.dict import PersistentDict
 from persistent.list import PersistentList
+from BTrees.OOBTree import OOBTree
+from BTrees.IOBTree import IOBTree
+from BTrees.IIBTree import IITreeSet
+from BTrees.Length import Length
 
 from twisted.internet import reactor
 
@@ -43,6 +48,9 @@ if __name__ == '__main__':
     conf.load_plugins = False
 
 from conf import datafs, backupdir, datafsname
+from conf import pack_interval, pack_days, tzid_block
+from conf import storage, zeo_address, conflict_retries, conflict_backoff
+from conf import cache_size, cache_size_bytes, pool_size
 
 class TZODB(object):
     'Database object. A Borg object with state which all share.'
@@ -64,16 +72,43 @@ class TZODB(object):
 
         if not hasattr(self, 'storage'):
             self.open(fname)
-            reactor.callLater(30, self.pack_regularly)
+            self.packing = False
+            self.pack_started = None
+            self.pack_finished = None
+            self.pack_size_before = None
+            self.pack_size_after = None
+            self.pack_error = None
+            self.pack_waiters = []
+            if pack_interval:
+                reactor.callLater(30, self.pack_regularly)
 
     def open(self, fname):
-        'Open connection to the database.'
+        '''Open connection to the database.
 
-        self.storage = FileStorage.FileStorage(fname, read_only=self.read_only)
-        self.db = DB(self.storage)
+        If conf.storage is 'zeo' the main database is reached through the
+            ZEO server at conf.zeo_address, so that other processes can
+            use the database at the same time. Backup files are always
+            opened directly.
+
+        '''
+
+        if storage == 'zeo' and fname == datafs:
+            from ZEO.ClientStorage import ClientStorage
+            self.storage = ClientStorage(zeo_address,
+                                            read_only=self.read_only)
+        else:
+            self.storage = FileStorage.FileStorage(fname,
+                                            read_only=self.read_only)
+        self.db = DB(self.storage, pool_size=pool_size,
+                        cache_size=cache_size,
+                        cache_size_bytes=cache_size_bytes)
         self.conn = self.db.open()
         self.root = self.conn.root()
 
+        import time
+        self._opened = time.time()
+        self._stats_last = None
+
     def close(self):
         'Close database connection.'
 
@@ -91,6 +126,52 @@ class TZODB(object):
     def check_version(self):
         return self.version() == DB_VERSION
 
+    def cache_stats(self):
+        '''Return a dictionary of statistics about the object cache of
+            the main connection.
+
+        size: objects in the cache (including ghosts)
+        active: objects in the cache which are loaded
+        ghosts: objects in the cache which are not loaded
+        target: the cache_size setting
+        bytes: estimated size of the loaded objects
+        target_bytes: the cache_size_bytes setting (0 means no limit)
+        loads: objects read from storage since the last call
+        stores: objects written to storage since the last call
+        seconds: time since the last call
+        loads_per_second: loads / seconds
+
+        '''
+
+        import time
+        cache = self.conn._cache
+        size = len(cache)
+        active = cache.cache_non_ghost_count
+        loads, stores = self.conn.getTransferCounts(clear=True)
+
+        now = time.time()
+        if self._stats_last is None:
+            seconds = now - self._opened
+        else:
+            seconds = now - self._stats_last
+        self._stats_last = now
+
+        if seconds > 0:
+            loads_per_second = loads / seconds
+        else:
+            loads_per_second = 0.0
+
+        return dict(size=size,
+                    active=active,
+                    ghosts=size-active,
+                    target=cache_size,
+                    bytes=getattr(cache, 'total_estimated_size', 0),
+                    target_bytes=cache_size_bytes,
+                    loads=loads,
+                    stores=stores,
+                    seconds=seconds,
+                    loads_per_second=loads_per_second)
+
     def begin(self):
         'Start a new database transaction.'
 
@@ -109,17 +190,121 @@ class TZODB(object):
         transaction.abort()
 
     def pack(self):
-        'Pack the DB to remove old versions, like vacuum.'
+        '''Pack the DB to remove old versions, like vacuum.
+
+        Blocks until the pack is complete. While the server is running
+            use pack_background instead.
+
+        '''
 
         import time
-        self.storage.pack(time.time(), serialize.referencesf)
+        self.storage.pack(time.time() - pack_days*86400,
+                            serialize.referencesf)
         print 'DB Packed'
 
+    def pack_background(self):
+        '''Pack the DB in a worker thread so that the reactor keeps running.
+
+        Revisions newer than pack_days are kept. Returns False without
+            doing anything if a pack or a backup is already running.
+
+        '''
+
+        import backup
+        if self.packing or backup.running():
+            return False
+
+        import time
+        from twisted.internet import threads
+
+        self.packing = True
+        self.pack_started = time.time()
+        self.pack_finished = None
+        self.pack_size_before = self.storage.getSize()
+        self.pack_size_after = None
+        self.pack_error = None
+
+        packtime = self.pack_started - pack_days*86400
+        d = threads.deferToThread(self.storage.pack, packtime,
+                                    serialize.referencesf)
+        d.addCallbacks(self._pack_done, self._pack_failed)
+
+        return True
+
+    def _pack_done(self, result):
+        import time
+        self.packing = False
+        self.pack_finished = time.time()
+        self.pack_size_after = self.storage.getSize()
+        print 'DB Packed in %.1f seconds' % self.pack_duration()
+        self._pack_wake()
+
+    def _pack_failed(self, failure):
+        import time
+        self.packing = False
+        self.pack_finished = time.time()
+        self.pack_error = failure.getErrorMessage()
+        print 'DB pack failed:', self.pack_error
+        self._pack_wake()
+
+    def _pack_wake(self):
+        waiters = self.pack_waiters
+        self.pack_waiters = []
+        for d in waiters:
+            d.callback(None)
+
+    def pack_wait(self):
+        '''Return a Deferred which fires when the pack which is running
+            now is finished, or right away if no pack is running.
+
+        The storage must not be closed while the pack is running.
+
+        '''
+
+        from twisted.internet import defer
+        if not self.packing:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.pack_waiters.append(d)
+        return d
+
+    def pack_duration(self):
+        '''Return the number of seconds the current pack has been running,
+            or the number of seconds the last pack took. Returns None if
+            the DB has not been packed since the server started.
+
+        '''
+
+        import time
+        if self.pack_started is None:
+            return None
+        elif self.packing:
+            return time.time() - self.pack_started
+        else:
+            return self.pack_finished - self.pack_started
+
+    def pack_progress(self):
+        '''Return the number of bytes written so far by the current pack.
+
+        FileStorage writes the packed copy of the DB to a separate file
+            and swaps it in when done, so the size of that file shows
+            how far along the pack is. It will always be smaller than
+            the original size if there was anything to pack.
+
+        '''
+
+        import os
+        fname = getattr(self.storage, '_file_name', datafs)
+        packfile = '%s.pack' % fname
+        if self.packing and os.path.exists(packfile):
+            return os.path.getsize(packfile)
+        else:
+            return None
+
     def pack_regularly(self):
         'Pack the DB every pack_interval seconds.'
 
-        self.pack()
-        pack_interval = 600 #seconds (10 minutes)
+        self.pack_background()
         reactor.callLater(pack_interval, self.pack_regularly)
 
     def __str__(self):
@@ -133,17 +318,437 @@ class TZODB(object):
         return unicode(items)
 
 
+def _tzrepr(mapping):
+    'Show a mapping of MUD objects by the names of the objects.'
+
+    items = []
+    for k, v in mapping.items():
+        try:
+            items.append(u'%s: %s' % (k, v.name))
+        except AttributeError:
+            items.append(unicode(k))
+    return '{' + ', '.join(items) + '}'
+
+
+class TZCommitter(object):
+    '''Coordinates database commits. A Borg object with shared state.
+
+    Rather than committing after every command, mob action, or room
+        action, all of the work done during one pass through the
+        reactor loop is committed together in a single transaction.
+
+    Each piece of work should run inside its own savepoint so that
+        if it fails, only the changes made by that piece of work are
+        rolled back. Either get a savepoint() and roll it back when
+        there is a problem, or use run() or guard() to do that
+        automatically.
+
+    When more than one process uses the database (see conf.storage)
+        the transaction may fail with a ConflictError. Work registered
+        with retryable() is then run again in a new transaction, up to
+        conf.conflict_retries times, waiting a little longer before
+        each attempt. Other work done in the failed transaction (mob
+        actions, periodic room updates) is dropped and will simply
+        happen again the next time around.
+
+    Output for the clients is collected with write() and sent, one
+        write per client, only when the transaction is committed. It
+        is thrown away if the transaction is aborted, and output made
+        after a savepoint is thrown away if the savepoint is rolled
+        back.
+
+    Anything else which must only happen if the transaction is
+        committed should be registered with after_commit(). Cleanup
+        for when the transaction is aborted can be registered with
+        after_abort().
+
+    generation goes up by one every time changes are thrown away
+        (a savepoint rolled back or a transaction aborted). Values
+        worked out from the database and kept in volatile attributes
+        can remember the generation they were made in, and be made
+        again when it changes.
+
+    '''
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self):
+        if not hasattr(self, 'pending'):
+            self.pending = False
+            self.doomed = False
+            self.replays = []
+            self.attempt = 0
+            self.on_commit = []
+            self.on_abort = []
+            self.outbufs = {}
+            self.commits = 0
+            self.failures = 0
+            self.conflicts = 0
+            self.generation = 0
+            self.retrying = []
+            self.given_up = []
+
+    def savepoint(self):
+        '''Return a new savepoint in the current transaction and make
+            sure that the transaction will be committed soon.
+
+        '''
+
+        self.request()
+        return TZSavepoint(self)
+
+    def retryable(self, func, *args):
+        '''func(*args) is being run in the current transaction. If the
+            transaction fails with a ConflictError, call it again in
+            a new transaction.
+
+        '''
+
+        self.replays.append((self.attempt, func, args))
+
+    def write(self, client, data):
+        '''Queue data to be written to the transport of the given client
+            when the current transaction is committed.
+
+        '''
+
+        buf = self.outbufs.get(client)
+        if buf is None:
+            buf = []
+            self.outbufs[client] = buf
+            self.request()
+        buf.append(data)
+
+    def output_marks(self):
+        'Return the current length of the output queued for each client.'
+
+        marks = {}
+        for client, buf in self.outbufs.items():
+            marks[client] = len(buf)
+        return marks
+
+    def rollback_output(self, marks):
+        'Throw away output queued since output_marks() returned marks.'
+
+        for client, buf in self.outbufs.items():
+            del buf[marks.get(client, 0):]
+
+    def send_output(self):
+        'Send out all of the queued output. One write for each client.'
+
+        outbufs = self.outbufs
+        self.outbufs = {}
+        for client, buf in outbufs.items():
+            if buf:
+                client.transport.write(''.join(buf))
+
+    def after_commit(self, func, *args):
+        'Call func(*args) once the current transaction has been committed.'
+
+        self.on_commit.append((func, args))
+        self.request()
+
+    def after_abort(self, func, *args):
+        'Call func(*args) if the current transaction is aborted.'
+
+        self.on_abort.append((func, args))
+        self.request()
+
+    def conflict(self):
+        '''A ConflictError was raised while doing some work. The current
+            transaction cannot be committed, so abort it and run the
+            retryable work again.
+
+        '''
+
+        self.doomed = True
+        self.request()
+
+    def run(self, func, *args, **kw):
+        '''Call func(*args, **kw) inside a savepoint.
+
+        If func raises an exception, only the changes it made are rolled
+            back, then the exception is raised again.
+
+        '''
+
+        savepoint = self.savepoint()
+        try:
+            return func(*args, **kw)
+        except Exception, e:
+            savepoint.rollback(e)
+            raise
+
+    def guard(self, func, *args, **kw):
+        '''Call func(*args, **kw) inside a savepoint.
+
+        Like run() but if func raises an exception, the changes it made
+            are rolled back and the error is printed instead of being
+            raised. Useful for calls made directly from the reactor.
+
+        '''
+
+        try:
+            return self.run(func, *args, **kw)
+        except:
+            import traceback
+            traceback.print_exc()
+
+    def request(self):
+        'Commit the current transaction at the end of this reactor pass.'
+
+        if not self.pending:
+            self.pending = True
+            reactor.callLater(0, self.flush)
+
+    def flush(self):
+        'Commit the current transaction now.'
+
+        import db
+        self.pending = False
+        replays = self.replays
+        self.replays = []
+        doomed = self.doomed
+        self.doomed = False
+        on_commit = self.on_commit
+        self.on_commit = []
+        on_abort = self.on_abort
+        self.on_abort = []
+
+        zodb = db.TZODB()
+        try:
+            if doomed:
+                raise ConflictError
+            zodb.commit()
+        except ConflictError:
+            print 'TZCommitter.flush CONFLICT'
+            zodb.abort()
+            self.generation += 1
+            self.outbufs = {}
+            self.conflicts += 1
+            self.retry(replays)
+            self._call_all(on_abort)
+            self.retrying = []
+            self.given_up = []
+        except:
+            import traceback
+            traceback.print_exc()
+            print 'TZCommitter.flush ABORT'
+            zodb.abort()
+            self.generation += 1
+            self.outbufs = {}
+            self.failures += 1
+            self._call_all(on_abort)
+        else:
+            self.commits += 1
+            self.send_output()
+            self._call_all(on_commit)
+
+    def _call_all(self, calls):
+        for func, args in calls:
+            try:
+                func(*args)
+            except:
+                import traceback
+                traceback.print_exc()
+
+    def retry(self, replays):
+        '''Schedule the work from a transaction which had a conflict to
+            run again in a new transaction.
+
+        Work which has already been tried conflict_retries times is
+            dropped (see gave_up()). The delay before trying again doubles with each
+            attempt, to give the other process time to finish up.
+
+        '''
+
+        retries = []
+        given_up = []
+        for attempt, func, args in replays:
+            if attempt >= conflict_retries:
+                print 'TZCommitter.retry GIVING UP', func
+                given_up.append((attempt, func, args))
+            else:
+                retries.append((attempt, func, args))
+
+        self.retrying = retries
+        self.given_up = given_up
+        if retries:
+            attempt = max([r[0] for r in retries])
+            delay = conflict_backoff * 2**attempt
+            reactor.callLater(delay, self.replay, retries)
+
+    def will_retry(self, func):
+        '''Return True if func is going to be run again because the
+            transaction was aborted.
+
+        Only useful in a function registered with after_abort().
+
+        '''
+
+        for attempt, f, args in self.retrying:
+            if f == func:
+                return True
+        return False
+
+    def gave_up(self, func):
+        '''Return True if func is not going to be run again because it
+            already had too many conflicts.
+
+        Only useful in a function registered with after_abort(), to let
+            someone know that their work was dropped.
+
+        '''
+
+        for attempt, f, args in self.given_up:
+            if f == func:
+                return True
+        return False
+
+    def replay(self, replays):
+        'Run again the work from a transaction which had a conflict.'
+
+        for attempt, func, args in replays:
+            self.attempt = attempt + 1
+            try:
+                func(*args)
+            except:
+                import traceback
+                traceback.print_exc()
+            self.attempt = 0
+
+
+class TZSavepoint(object):
+    '''A savepoint in the current transaction.
+
+    Returned by TZCommitter.savepoint(). If it is rolled back because of
+        a ConflictError, the committer is told that the transaction can
+        no longer be committed.
+
+    '''
+
+    def __init__(self, committer):
+        self.committer = committer
+        self.savepoint = transaction.savepoint(True)
+        self.marks = committer.output_marks()
+
+    def rollback(self, error=None):
+        '''Discard all changes made since this savepoint was created,
+            along with any output queued since then.
+
+        Pass the exception which caused the rollback (if any) as error.
+
+        '''
+
+        if isinstance(error, ConflictError):
+            self.committer.conflict()
+        self.savepoint.rollback()
+        self.committer.generation += 1
+        self.committer.rollback_output(self.marks)
+
+
+class TZIdAllocator(object):
+    '''Hands out new id numbers. A Borg object with shared state.
+
+    Instead of updating the shared counter for every new object,
+        reserve a block of tzid_block id numbers at a time and hand
+        them out from memory.
+
+    Each block is reserved in a separate transaction on a separate
+        connection and committed right away, so the reservation holds
+        even if the transaction creating the objects is aborted, and
+        no number is ever handed out twice, even after a crash. Any
+        numbers left over in a block when the server stops are never
+        used.
+
+    '''
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self):
+        if not hasattr(self, 'nextid'):
+            self.nextid = 1
+            self.limit = 0
+
+    def reserve(self):
+        '''Reserve a new block of id numbers.
+
+        If another process is reserving a block at the same time, try
+            again, up to conflict_retries times. After that the
+            ConflictError is raised.
+
+        '''
+
+        import db
+        from ZODB.POSException import ConflictError
+
+        zodb = db.TZODB()
+        tm = transaction.TransactionManager()
+        conn = zodb.db.open(transaction_manager=tm)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    share = conn.root()['share']
+                    previd = share['tzid']
+                    share['tzid'] = previd + tzid_block
+                    tm.commit()
+                except ConflictError:
+                    tm.abort()
+                    attempt += 1
+                    if attempt > conflict_retries:
+                        raise
+                else:
+                    break
+        finally:
+            conn.close()
+
+        self.nextid = previd + 1
+        self.limit = previd + tzid_block
+
+    def allocate(self):
+        'Return the next available id number.'
+
+        if self.nextid > self.limit:
+            self.reserve()
+        tzid = self.nextid
+        self.nextid += 1
+        return tzid
+
+
 class TZDict(PersistentDict):
     'Customized persistent dictionary.'
 
     def __repr__(self):
-        items = []
-        for k, v in self.items():
-            try:
-                items.append(u'%s: %s' % (k, v.name))
-            except AttributeError:
-                items.append(unicode(k))
-        return '{' + ', '.join(items) + '}'
+        return _tzrepr(self)
+
+
+class TZIdTree(IOBTree):
+    '''Persistent BTree mapping id numbers to MUD objects.
+
+    Only the buckets which actually change are written when an
+        object is added or removed, so the cost of a commit does
+        not grow with the number of objects in the MUD.
+
+    '''
+
+    def __repr__(self):
+        return _tzrepr(self)
+
+
+class TZNameTree(OOBTree):
+    'Persistent BTree mapping names to MUD objects.'
+
+    def __repr__(self):
+        return _tzrepr(self)
 
 
 class TZIndex(object):
@@ -163,7 +768,7 @@ class TZIndex(object):
 
     def idx(self):
         '''Return the root of this index.
-        Should reference a TZDict or a PersistentDict.
+        Should reference a TZIdTree (or other IOBTree).
 
         '''
 
@@ -183,17 +788,261 @@ class TZIndex(object):
         'Return the entry with the given id number.'
 
         i = self.idx()
-        return i.get(tzid, None)
+        try:
+            return i.get(tzid, None)
+        except TypeError:
+            # not an id number. (None, for instance)
+            return None
 
     def ls(self):
         'Return a list of the objects referenced by the index.'
 
         idx = self.idx()
-        return idx.values()
+        return list(idx.values())
 
+    def iterls(self):
+        '''Return an iterator over the objects referenced by the index.
 
-def db_init():
-    print 'initializing ZODB'
+        Unlike ls() this does not build a list of every object, so it
+            can be used to go through a very large database.
+
+        '''
+
+        idx = self.idx()
+        return iter(idx.values())
+
+
+def normalize_name(name):
+    'Return the form of the given name used as a key in the name index.'
+
+    if isinstance(name, unicode):
+        return name
+    try:
+        return unicode(name)
+    except UnicodeDecodeError:
+        return name.decode('utf-8', 'replace')
+
+
+class TZNameIndex(object):
+    '''Index of the names of all MUD objects. A Borg object with shared state.
+
+    Maps each name to the set of id numbers of the objects which use it,
+        so that objects can be found by name without loading every object
+        in the database. Main names and other names (name_aka) are kept
+        in separate trees so that a search can skip the other names.
+
+    '''
+
+    articles = ('a ', 'an ', 'the ')
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self, dbroot=None):
+        if dbroot is not None:
+            self.dbroot = dbroot
+        elif not hasattr(self, 'dbroot'):
+            import db
+            zodb = db.TZODB()
+            self.dbroot = zodb.root
+
+    def names(self):
+        'Return the tree of main names. Maps name --> IITreeSet of tzid.'
+
+        return self.dbroot['_names']
+
+    def akas(self):
+        'Return the tree of other names. Maps name --> IITreeSet of tzid.'
+
+        return self.dbroot['_akas']
+
+    def changed(self):
+        '''The name or other names of some object have changed.
+
+        Moves on the number returned by serial(). The number is kept in
+            the database (as a BTrees Length, so that changes made by
+            different processes at the same time do not conflict) so
+            that every process sees the change.
+
+        '''
+
+        self.dbroot['_names_serial'].change(1)
+
+    def serial(self):
+        'Return a number which changes whenever any name changes.'
+
+        return self.dbroot['_names_serial']()
+
+    def _insert(self, tree, name, tzid):
+        key = normalize_name(name)
+        tzids = tree.get(key)
+        if tzids is None:
+            tzids = IITreeSet()
+            tree[key] = tzids
+        tzids.insert(tzid)
+
+    def _discard(self, tree, name, tzid):
+        key = normalize_name(name)
+        tzids = tree.get(key)
+        if tzids is not None and tzid in tzids:
+            tzids.remove(tzid)
+            if not tzids:
+                del tree[key]
+
+    def add(self, tzobj):
+        'Index the name and all of the other names of the given object.'
+
+        tzid = tzobj.tzid
+        self._insert(self.names(), tzobj.name, tzid)
+        for aka in tzobj.name_aka:
+            self._insert(self.akas(), aka, tzid)
+
+    def remove(self, tzobj):
+        'Remove all of the names of the given object from the index.'
+
+        tzid = tzobj.tzid
+        self._discard(self.names(), tzobj.name, tzid)
+        for aka in tzobj.name_aka:
+            self._discard(self.akas(), aka, tzid)
+
+    def rename(self, tzobj, oldname, newname):
+        'The main name of the given object has changed.'
+
+        tzid = tzobj.tzid
+        if oldname is not None:
+            self._discard(self.names(), oldname, tzid)
+        self._insert(self.names(), newname, tzid)
+
+    def addaka(self, tzobj, aka):
+        'The given object has a new other name.'
+
+        self._insert(self.akas(), aka, tzobj.tzid)
+
+    def rmaka(self, tzobj, aka):
+        'The given object no longer uses the other name.'
+
+        self._discard(self.akas(), aka, tzobj.tzid)
+
+    def lookup(self, name, akas=True):
+        '''Return a list of the id numbers of the objects with the given name.
+
+        Objects with the given main name come first, followed by objects
+            which have the name in their name_aka list. Pass akas=False
+            to only search the main names.
+
+        If the name begins with an article ("a ", "an ", "the ") the name
+            with the article removed is searched for as well.
+
+        '''
+
+        key = normalize_name(name)
+        keys = [key]
+        for article in self.articles:
+            if key.startswith(article):
+                keys.append(key[len(article):])
+
+        trees = [self.names()]
+        if akas:
+            trees.append(self.akas())
+
+        result = []
+        found = set()
+        for k in keys:
+            for tree in trees:
+                tzids = tree.get(k)
+                if tzids is None:
+                    continue
+                for tzid in tzids:
+                    if tzid not in found:
+                        found.add(tzid)
+                        result.append(tzid)
+
+        return result
+
+
+class TZLinkIndex(object):
+    '''Index of the exits between rooms. A Borg object with shared state.
+
+    Maps (room id, destination id) to the set of id numbers of the exits
+        in the room which lead to the destination, so that the way back
+        from a room can be found without looking at every exit there.
+
+    Kept up to date by the room and destination properties of Exit.
+
+    '''
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self, dbroot=None):
+        if dbroot is not None:
+            self.dbroot = dbroot
+        elif not hasattr(self, 'dbroot'):
+            import db
+            zodb = db.TZODB()
+            self.dbroot = zodb.root
+
+    def links(self):
+        '''Return the tree of links.
+
+        Maps (room id, destination id) --> IITreeSet of exit tzid.
+
+        '''
+
+        return self.dbroot['_links']
+
+    def link(self, rid, destid, xid):
+        'Exit xid in room rid now leads to destid.'
+
+        if rid is None or destid is None:
+            return
+        tree = self.links()
+        key = (rid, destid)
+        xids = tree.get(key)
+        if xids is None:
+            xids = IITreeSet()
+            tree[key] = xids
+        xids.insert(xid)
+
+    def unlink(self, rid, destid, xid):
+        'Exit xid in room rid no longer leads to destid.'
+
+        if rid is None or destid is None:
+            return
+        tree = self.links()
+        key = (rid, destid)
+        xids = tree.get(key)
+        if xids is not None and xid in xids:
+            xids.remove(xid)
+            if not xids:
+                del tree[key]
+
+    def add(self, x):
+        'Index the given exit.'
+
+        self.link(x._rid, getattr(x, '_destid', None), x.tzid)
+
+    def lookup(self, rid, destid):
+        '''Return a list of the id numbers of the exits in room rid
+            which lead to destid.
+
+        '''
+
+        xids = self.links().get((rid, destid))
+        if xids is None:
+            return []
+        else:
+            return list(xids)
+
+
+def db_init_tables():
+    'Create the empty indexes and tables for a new database.'
 
     import db
     zodb = db.TZODB()
@@ -202,7 +1051,11 @@ def db_init():
     dbroot['DB_VERSION'] = DB_VERSION
 
 
-    dbroot['_index'] = db.TZDict()
+    dbroot['_index'] = db.TZIdTree()
+    dbroot['_names'] = OOBTree()
+    dbroot['_akas'] = OOBTree()
+    dbroot['_names_serial'] = Length()
+    dbroot['_links'] = OOBTree()
 
 
     dbroot['share'] = db.TZDict()
@@ -210,12 +1063,28 @@ def db_init():
     zodb.commit()
 
 
-    dbroot['rooms'] = db.TZDict()
-    zodb.commit()
+    dbroot['rooms'] = db.TZIdTree()
+    dbroot['exits'] = db.TZIdTree()
+    dbroot['players'] = db.TZNameTree()
+    dbroot['players']['_index'] = db.TZIdTree()
+    dbroot['items'] = db.TZIdTree()
+    dbroot['mobs'] = db.TZIdTree()
+
+    dbroot['admin'] = PersistentList()
+    dbroot['wizard'] = PersistentList()
+
+    import scheduler
+    dbroot['_schedule'] = scheduler.TZSchedule()
 
-    dbroot['exits'] = db.TZDict()
     zodb.commit()
 
+def db_init():
+    print 'initializing ZODB'
+
+    import db
+    zodb = db.TZODB()
+
+    db_init_tables()
 
     import rooms
     import exits
@@ -225,22 +1094,10 @@ def db_init():
     north = exits.Exit('the light', room=void,
                         destination=house)
 
-
-    dbroot['players'] = db.TZDict()
-    dbroot['players']['_index'] = db.TZDict()
-    zodb.commit()
-
-    dbroot['items'] = db.TZDict()
     import items
     rose = items.Rose()
     house.add(rose)
 
-
-    dbroot['admin'] = PersistentList()
-    dbroot['wizard'] = PersistentList()
-
-    dbroot['mobs'] = db.TZDict()
-
     zodb.commit()
 
 def db_upgrade(from_version, to_version):
@@ -264,6 +1121,8 @@ def db_upgrade(from_version, to_version):
         print '  Must upgrade from current version.'
         return
 
+    db.upgrade(from_version, to_version)
+
     for mod in 'players', 'mobs', 'items', 'rooms', 'exits':
         module = __import__(mod)
         if hasattr(module, 'upgrade'):
@@ -275,6 +1134,92 @@ def db_upgrade(from_version, to_version):
 
     db_upgradeall()
 
+def upgrade(from_version, to_version):
+    '''Upgrade the containers and indexes kept in the database root.
+
+    Called from db_upgrade before any of the object modules are upgraded.
+
+    '''
+
+    import db
+    zodb = db.TZODB()
+    dbroot = zodb.root
+
+    if from_version==4 and to_version==5:
+        print '  building name index'
+        dbroot['_names'] = OOBTree()
+        dbroot['_akas'] = OOBTree()
+        nameindex = db.TZNameIndex()
+        for obj in dbroot['_index'].values():
+            nameindex.add(obj)
+        zodb.commit()
+
+    elif from_version==5 and to_version==6:
+        for key in '_index', 'rooms', 'items', 'mobs', 'exits':
+            print '  converting', key
+            old = dbroot[key]
+            dbroot[key] = db.TZIdTree()
+            _copy_mapping(old, dbroot[key])
+            zodb.commit()
+
+        print '  converting players'
+        old = dbroot['players']
+        dbroot['players'] = db.TZNameTree()
+        dbroot['players']['_index'] = db.TZIdTree()
+        _copy_mapping(old['_index'], dbroot['players']['_index'])
+        for name, player in old.items():
+            if name != '_index':
+                dbroot['players'][name] = player
+        zodb.commit()
+
+    elif from_version==6 and to_version==7:
+        from share import TZIdSet
+        idattrs = ['_item_ids', '_mob_ids', '_player_ids', '_exit_ids',
+                    '_wearing_ids']
+        print '  converting id lists'
+        for n, obj in enumerate(dbroot['_index'].values()):
+            for attr in idattrs:
+                ids = getattr(obj, attr, None)
+                if ids is not None and not isinstance(ids, TZIdSet):
+                    setattr(obj, attr, TZIdSet(ids))
+            if n % 1000 == 999:
+                transaction.savepoint(True)
+        zodb.commit()
+
+    elif from_version==8 and to_version==9:
+        import scheduler
+        print '  scheduling mobs and rooms'
+        dbroot['_schedule'] = scheduler.TZSchedule()
+        n = scheduler.seed(dbroot['_schedule'])
+        print '  scheduled', n
+        zodb.commit()
+
+    elif from_version==9 and to_version==10:
+        print '  building exit link index'
+        dbroot['_links'] = OOBTree()
+        linkindex = db.TZLinkIndex()
+        for x in dbroot['exits'].values():
+            linkindex.add(x)
+        zodb.commit()
+
+    elif from_version==10 and to_version==11:
+        dbroot['_names_serial'] = Length()
+        zodb.commit()
+
+def _copy_mapping(old, new):
+    '''Copy all of the entries from the old mapping in to the new one.
+
+    The new mapping should already be stored in the database. Uses
+        savepoints so that a large mapping does not need to be held
+        in memory all at once.
+
+    '''
+
+    for n, (k, v) in enumerate(old.items()):
+        new[k] = v
+        if n % 1000 == 999:
+            transaction.savepoint(True)
+
 def db_upgradeall():
     import share
     share.upgradeall()
@@ -315,7 +1260,9 @@ def db_depopulate():
     zodb = TZODB(fname)
     dbroot = zodb.root
 
-    names = dbroot['players'].keys()
+    nameindex = TZNameIndex(dbroot)
+
+    names = list(dbroot['players'].keys())
     for name in names:
         if name == '_index':
             continue
@@ -326,6 +1273,7 @@ def db_depopulate():
         del dbroot['players'][name]
         del dbroot['players']['_index'][player.tzid]
         del dbroot['_index'][player.tzid]
+        nameindex.remove(player)
         if name in dbroot['admin']:
             dbroot['admin'].remove(name)
         if name in dbroot['wizard']:
@@ -339,6 +1287,47 @@ def db_depopulate():
     for pth in pths:
         os.remove(pth)
 
+def db_export():
+    if len(sys.argv) != 3:
+        print 'Usage: db.py export <filename>'
+        sys.exit(1)
+
+    import db
+    import zc
+    try:
+        zodb = db.TZODB()
+    except zc.lockfile.LockError:
+        print '  DB locked. Shut down server before exporting'
+        return
+
+    import share
+    share.load_plugins()
+
+    import export
+    export.export(sys.argv[2])
+
+def db_import():
+    if len(sys.argv) != 3:
+        print 'Usage: db.py import <filename>'
+        sys.exit(1)
+
+    import db
+    import zc
+    try:
+        zodb = db.TZODB()
+    except zc.lockfile.LockError:
+        print '  DB locked. Shut down server before importing'
+        return
+
+    if '_index' not in zodb.root:
+        db_init_tables()
+
+    import share
+    share.load_plugins()
+
+    import export
+    export.import_(sys.argv[2])
+
 def db_display(fname=None):
     import db
     zodb = db.TZODB(fname, read_only=True)
@@ -358,6 +1347,10 @@ if __name__ == '__main__':
         db_pack()
     elif len(sys.argv) > 1 and sys.argv[1] == 'depopulate':
         db_depopulate()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'export':
+        db_export()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'import':
+        db_import()
     elif len(sys.argv) > 1:
         fname = sys.argv[1]
         print 'Reading backup ZODB', fname
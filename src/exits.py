@@ -25,7 +25,7 @@ from persistent.list import PersistentList
 
 from share import TZObj
 
-from db import TZODB, TZIndex
+from db import TZODB, TZIndex, TZNameIndex, TZLinkIndex
 zodb = TZODB()
 dbroot = zodb.root
 commit = zodb.commit
@@ -33,15 +33,22 @@ abort = zodb.abort
 
 import rooms
 import players
+from scheduler import TZInterest
 from colors import green, yellow, red
 
 tzindex = TZIndex()
+nameindex = TZNameIndex()
+linkindex = TZLinkIndex()
 
 
 def get(xid):
     'Return the exit with the given id number.'
 
-    return dbroot['exits'].get(xid, None)
+    try:
+        return dbroot['exits'].get(xid, None)
+    except TypeError:
+        # not an id number. (None, for instance)
+        return None
 
 def add(x):
     'Add the given exit to the database.'
@@ -64,8 +71,9 @@ def getname(name, all=False):
     '''
 
     result = []
-    for x in ls():
-        if x.name == name:
+    for tzid in nameindex.lookup(name, akas=False):
+        x = get(tzid)
+        if x is not None:
             if not all:
                 return x
             else:
@@ -79,7 +87,7 @@ def getname(name, all=False):
 def ls():
     'Return a list of all the exits in the database.'
 
-    return dbroot['exits'].values()
+    return list(dbroot['exits'].values())
 
 def names():
     '''Return a list of the names of all the exits in the database.
@@ -92,7 +100,7 @@ def names():
     return [x.name for x in dbroot['exits'].values()]
 
 def isexit(obj):
-    return obj in ls()
+    return get(getattr(obj, 'tzid', None)) is obj
 
 
 class Exit(TZObj):
@@ -271,10 +279,14 @@ class Exit(TZObj):
 
     def _set_room(self, room):
         'Setter for the room property.'
+        destid = getattr(self, '_destid', None)
+        linkindex.unlink(self._rid, destid, self.tzid)
         if room is not None:
             self._rid = room.tzid
         else:
             self._rid = None
+        linkindex.link(self._rid, destid, self.tzid)
+        TZInterest().changed()
     def _get_room(self):
         'Getter for the room property.'
         return rooms.get(self._rid)
@@ -282,10 +294,13 @@ class Exit(TZObj):
 
     def _set_destination(self, destination):
         'Setter for the destination property.'
+        linkindex.unlink(self._rid, getattr(self, '_destid', None), self.tzid)
         if destination is not None:
             self._destid = destination.tzid
         else:
             self._destid = None
+        linkindex.link(self._rid, self._destid, self.tzid)
+        TZInterest().changed()
     def _get_destination(self):
         'Getter for the destination property.'
         return rooms.get(self._destid)
@@ -0,0 +1,313 @@
+# Copyright 2008 Lee Harr
+#
+# This file is part of TZMud.
+#
+# TZMud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TZMud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TZMud.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Export objects from / import objects to the database.
+
+The export file has one line for each object, each line a JSON object:
+
+    {"module": "items", "class": "Rose", "tzid": 12, "state": {...}}
+
+The state holds all of the attributes of the object. Values which
+    JSON does not handle directly are written as a JSON object with
+    a single key that says what kind of value it is:
+
+    {"__ref__": 7}            reference to the MUD object with tzid 7
+    {"__ids__": [1, 2, 3]}    TZIdSet
+    {"__str__": "abc"}        byte string (plain strings are unicode)
+    {"__plist__": [...]}      PersistentList
+    {"__tuple__": [...]}      tuple
+    {"__set__": [...]}        set (also "__frozenset__")
+    {"__dict__": [[k, v]]}    dict (also "__pdict__" and "__tzdict__")
+
+The first line is a header with the database version and the lists
+    of admins and wizards.
+
+Export goes through the database one object at a time, and import
+    reads the file one line at a time and commits every so often, so
+    neither needs to hold the whole world in memory.
+
+'''
+
+
+import json
+
+from persistent.list import PersistentList
+from persistent.dict import PersistentDict
+
+from db import TZODB, TZIndex, TZNameIndex, TZLinkIndex, TZDict, DB_VERSION
+zodb = TZODB()
+dbroot = zodb.root
+commit = zodb.commit
+
+tzindex = TZIndex()
+nameindex = TZNameIndex()
+linkindex = TZLinkIndex()
+
+from share import TZObj, TZIdSet, class_mod
+
+import rooms
+import items
+import mobs
+import exits
+import players
+
+
+class ExportError(ValueError):
+    'Raised for a value which cannot be exported.'
+    pass
+
+
+def encode(val):
+    'Return the given value in a form which can be written as JSON.'
+
+    if val is None or isinstance(val, (bool, int, long, float, unicode)):
+        return val
+    elif isinstance(val, str):
+        try:
+            return dict(__str__=val.decode('utf-8'))
+        except UnicodeDecodeError:
+            return dict(__str__=val.decode('latin-1'))
+    elif isinstance(val, TZObj):
+        return dict(__ref__=val.tzid)
+    elif isinstance(val, TZIdSet):
+        return dict(__ids__=list(val))
+    elif isinstance(val, PersistentList):
+        return dict(__plist__=[encode(v) for v in val])
+    elif isinstance(val, list):
+        return [encode(v) for v in val]
+    elif isinstance(val, tuple):
+        return dict(__tuple__=[encode(v) for v in val])
+    elif isinstance(val, frozenset):
+        return dict(__frozenset__=[encode(v) for v in val])
+    elif isinstance(val, set):
+        return dict(__set__=[encode(v) for v in val])
+    elif isinstance(val, TZDict):
+        return dict(__tzdict__=encode_items(val))
+    elif isinstance(val, PersistentDict):
+        return dict(__pdict__=encode_items(val))
+    elif isinstance(val, dict):
+        return dict(__dict__=encode_items(val))
+    else:
+        raise ExportError, 'Cannot export %r' % (val,)
+
+def encode_items(d):
+    return [[encode(k), encode(v)] for k, v in d.items()]
+
+
+class Ref(object):
+    '''Stands in for a reference to an object which has not been
+        imported yet.
+
+    '''
+
+    def __init__(self, tzid):
+        self.tzid = tzid
+
+
+def decode(val, refs):
+    '''Return the value that was encoded as val.
+
+    Any reference to an object which has not been imported yet is
+        returned as a Ref and refs[0] is set to True.
+
+    '''
+
+    if isinstance(val, list):
+        return [decode(v, refs) for v in val]
+    elif not isinstance(val, dict):
+        return val
+
+    kind, v = val.items()[0]
+    if kind == '__ref__':
+        obj = tzindex.get(v)
+        if obj is None:
+            refs[0] = True
+            obj = Ref(v)
+        return obj
+    elif kind == '__ids__':
+        return TZIdSet(v)
+    elif kind == '__str__':
+        return v.encode('utf-8')
+    elif kind == '__plist__':
+        return PersistentList([decode(i, refs) for i in v])
+    elif kind == '__tuple__':
+        return tuple([decode(i, refs) for i in v])
+    elif kind == '__frozenset__':
+        return frozenset([decode(i, refs) for i in v])
+    elif kind == '__set__':
+        return set([decode(i, refs) for i in v])
+    elif kind in ('__dict__', '__pdict__', '__tzdict__'):
+        d = {'__dict__': dict,
+                '__pdict__': PersistentDict,
+                '__tzdict__': TZDict}[kind]()
+        for k, i in v:
+            d[decode(k, refs)] = decode(i, refs)
+        return d
+    else:
+        raise ValueError, 'Unknown value in import: %s' % kind
+
+def resolve(val):
+    'Replace any Ref inside val with the object it stands for.'
+
+    if isinstance(val, Ref):
+        return tzindex.get(val.tzid)
+    elif isinstance(val, (list, PersistentList)):
+        for i, v in enumerate(val):
+            val[i] = resolve(v)
+        return val
+    elif isinstance(val, (dict, PersistentDict)):
+        for k, v in val.items():
+            val[k] = resolve(v)
+        return val
+    elif isinstance(val, tuple):
+        return tuple([resolve(v) for v in val])
+    else:
+        return val
+
+
+def iterexport():
+    '''Generate the lines of an export of the whole database.
+
+    Objects are turned back in to ghosts once they have been written
+        out, so memory use does not grow with the size of the world.
+
+    '''
+
+    header = dict(DB_VERSION=dbroot['DB_VERSION'],
+                    admin=list(dbroot['admin']),
+                    wizard=list(dbroot['wizard']))
+    yield json.dumps(dict(__header__=encode(header)))
+
+    for n, obj in enumerate(tzindex.iterls()):
+        state = {}
+        for attr, val in obj.__getstate__().items():
+            try:
+                state[attr] = encode(val)
+            except ExportError, e:
+                print 'skipping', attr, 'of', obj.tzid, e
+        cls = obj.__class__
+        yield json.dumps(dict(module=cls.__module__,
+                                tzid=obj.tzid,
+                                state=state,
+                                **{'class': cls.__name__}))
+        obj._p_deactivate()
+        if n % 1000 == 999:
+            zodb.conn.cacheGC()
+
+def export(path):
+    'Write an export of the whole database to the file at path.'
+
+    f = file(path, 'w')
+    n = 0
+    for line in iterexport():
+        f.write(line)
+        f.write('\n')
+        n += 1
+    f.close()
+
+    print 'exported', n-1, 'objects'
+
+
+def find_class(modname, clsname):
+    '''Return the class with the given name.
+
+    Plugin classes are also registered in the module for their base
+        class (see share.register_plugin) so look there too.
+
+    '''
+
+    try:
+        mod = __import__(modname)
+        return getattr(mod, clsname)
+    except (ImportError, AttributeError):
+        for mod in rooms, items, mobs, exits, players:
+            cls = getattr(mod, clsname, None)
+            if cls is not None:
+                return cls
+    raise ValueError, 'Unknown class %s.%s' % (modname, clsname)
+
+def import_(path, batch=1000):
+    '''Read an export file and add all of the objects to the database.
+
+    The database must not already hold any objects. Commits after every
+        batch objects.
+
+    '''
+
+    if dbroot['_index']:
+        raise ValueError, 'Can only import in to an empty database.'
+
+    maxid = 0
+    fixups = []
+    n = 0
+    for line in file(path):
+        line = line.strip()
+        if not line:
+            continue
+        data = json.loads(line)
+
+        if '__header__' in data:
+            header = decode(data['__header__'], [False])
+            if header['DB_VERSION'] != DB_VERSION:
+                raise ValueError, 'Export is from database version %s' % (
+                                                        header['DB_VERSION'])
+            dbroot['admin'].extend(header['admin'])
+            dbroot['wizard'].extend(header['wizard'])
+            continue
+
+        cls = find_class(data['module'], data['class'])
+        refs = [False]
+        state = {}
+        for attr, val in data['state'].items():
+            state[str(attr)] = decode(val, refs)
+
+        obj = cls.__new__(cls)
+        obj.__setstate__(state)
+        tzindex.add(obj)
+        nameindex.add(obj)
+        class_mod(obj).add(obj)
+
+        if refs[0]:
+            fixups.append(obj.tzid)
+        maxid = max(maxid, obj.tzid)
+
+        n += 1
+        if n % batch == 0:
+            commit()
+            zodb.conn.cacheGC()
+            print 'imported', n, 'objects'
+
+    for tzid in fixups:
+        obj = tzindex.get(tzid)
+        for attr, val in obj.__getstate__().items():
+            setattr(obj, attr, resolve(val))
+
+    for x in dbroot['exits'].values():
+        linkindex.add(x)
+
+    share = dbroot['share']
+    if share['tzid'] < maxid:
+        share['tzid'] = maxid
+
+    import scheduler
+    dbroot['_schedule'] = scheduler.TZSchedule()
+    scheduler.seed(dbroot['_schedule'])
+
+    commit()
+
+    print 'imported', n, 'objects'
@@ -30,10 +30,10 @@ from twisted.internet import reactor
 
 from persistent.list import PersistentList
 
-from db import TZODB, TZIndex
+from db import TZODB, TZIndex, TZNameIndex, TZCommitter
 dbroot = TZODB().root
 
-from share import TZObj, TZContainer
+from share import TZObj, TZContainer, names_changed
 from share import register_plugin
 
 import wizard
@@ -41,11 +41,18 @@ import players
 import mobs
 from colors import green
 
+nameindex = TZNameIndex()
+committer = TZCommitter()
+
 
 def get(iid):
     'Return the item with the given id number.'
 
-    return dbroot['items'].get(iid, None)
+    try:
+        return dbroot['items'].get(iid, None)
+    except TypeError:
+        # not an id number. (None, for instance)
+        return None
 
 def add(item):
     'Add the given item to the database.'
@@ -67,23 +74,24 @@ def getname(name, all=False):
 
     '''
 
-    result = set()
-    for item in ls():
-        if item.name == name or name in item.name_aka:
+    result = []
+    for tzid in nameindex.lookup(name):
+        item = get(tzid)
+        if item is not None:
             if not all:
                 return item
             else:
-                result.add(item)
+                result.append(item)
 
     if all:
-        return list(result)
+        return result
     else:
         return None
 
 def ls():
     'Return a list of all the items in the database.'
 
-    return dbroot['items'].values()
+    return list(dbroot['items'].values())
 
 def names():
     '''Return a list of the names of all the items in the database.
@@ -96,7 +104,7 @@ def names():
     return [item.name for item in dbroot['items'].values()]
 
 def isitem(obj):
-    return obj in ls()
+    return get(getattr(obj, 'tzid', None)) is obj
 
 
 
@@ -330,11 +338,13 @@ class InvRing(Ring):
         character.setting('visible', vis)
 
     def wear(self, character):
-        reactor.callLater(0.4, self._set_visible, character, False)
+        reactor.callLater(0.4, committer.guard, self._set_visible,
+                                                    character, False)
         return True
 
     def unwear(self, character):
-        reactor.callLater(0.4, self._set_visible, character, True)
+        reactor.callLater(0.4, committer.guard, self._set_visible,
+                                                    character, True)
         return True
 
 class CursedItem(Item):
@@ -440,14 +450,18 @@ class Coin(Item):
     name = property(_get_name, _set_name)
 
     def _set_n_coins(self, n):
+        oldname = self.name
         self._n_coins = n
+        if self.exists():
+            nameindex.rename(self, oldname, self.name)
+        names_changed(self)
 
     def add_coins(self, n):
-        self._n_coins += n
+        self._set_n_coins(self._n_coins + n)
 
     def remove_coins(self, n):
         if n <= self._n_coins:
-            self._n_coins -= n
+            self._set_n_coins(self._n_coins - n)
         else:
             raise ValueError
 
@@ -590,7 +604,7 @@ class TimeTrap(Trap):
 
     def activate(self):
         delay = self.setting('delay')
-        reactor.callLater(delay, self.spring)
+        reactor.callLater(delay, committer.guard, self.spring)
 
 class GetTimeTrap(TimeTrap, GetTrap):
     'TimeTrap activated by getting it.'
@@ -31,12 +31,13 @@ from twisted.internet import reactor
 from persistent.list import PersistentList
 from persistent.dict import PersistentDict
 
-from db import TZODB, TZIndex
+from db import TZODB, TZIndex, TZNameIndex, TZCommitter
 zodb = TZODB()
 dbroot = zodb.root
 abort = zodb.abort
 commit = zodb.commit
 
+import conf
 import tzprotocol
 
 import rooms
@@ -44,14 +45,25 @@ import exits
 import items
 
 from share import TZContainer, Character, class_as_string, int_attr, str_attr
-from share import register_plugin
+from share import register_plugin, volatile_caches
 from colors import magenta
 
+nameindex = TZNameIndex()
+committer = TZCommitter()
+
+from scheduler import TZScheduler, TZInterest
+scheduler = TZScheduler()
+interest = TZInterest()
+
 
 def get(mid):
     'Return the mob with the given id number.'
 
-    return dbroot['mobs'].get(mid, None)
+    try:
+        return dbroot['mobs'].get(mid, None)
+    except TypeError:
+        # not an id number. (None, for instance)
+        return None
 
 def add(mob):
     'Add the given mob to the database.'
@@ -74,8 +86,9 @@ def getname(name, all=False):
     '''
 
     result = []
-    for mob in ls():
-        if mob.name == name or name in mob.name_aka:
+    for tzid in nameindex.lookup(name):
+        mob = get(tzid)
+        if mob is not None:
             if not all:
                 return mob
             else:
@@ -89,7 +102,7 @@ def getname(name, all=False):
 def ls():
     'Return a list of all the mobs in the database.'
 
-    return dbroot['mobs'].values()
+    return list(dbroot['mobs'].values())
 
 def names():
     '''Return a list of the names of all the mobs in the database.
@@ -102,7 +115,7 @@ def names():
     return [mob.name for mob in dbroot['mobs'].values()]
 
 def ismob(obj):
-    return obj in ls()
+    return get(getattr(obj, 'tzid', None)) is obj
 
 
 def nudge_all():
@@ -167,6 +180,8 @@ Mob: %s (%s) [in room %s]: %s
         destination.addmob(self)
         self._rid = destination.tzid
 
+        interest.moved(self, destination)
+
     def message(self, *args):
         '''Dummy method, to make it easier to share methods
         between characters and players.
@@ -193,34 +208,58 @@ Mob: %s (%s) [in room %s]: %s
 
         for meth_name, weight in kw.items():
             self._action_weights[meth_name] = weight
+        self._v_cdf = None
 
     def set_default_action_weights(self):
         '''set all action_* methods to weight 100.'''
 
-        for meth_name in self.actions():
-            self._action_weights[meth_name] = 100
+        self.set_action_weights(**dict.fromkeys(self.actions(), 100))
 
     def actions(self):
         """return a list of this mob's possible actions.
 
         Names of actions should begin with action_
 
+        The list is made once for each class, by MetaTZObj.
+
         """
 
-        acts = [meth_name for meth_name in dir(self)
-                    if meth_name.startswith('action_')]
-        return acts
+        return list(self.__class__._action_names)
 
-    def action(self):
-        'Select a possible action using weighted choice'
+    def _cdf(self):
+        '''Return (action names, cumulative normalized weights) for
+            choosing an action.
+
+        Kept in a volatile attribute until the weights are changed with
+            set_action_weights() (or changes are rolled back). If
+            volatile_caches() is False, they are worked out every time,
+            since the weights may have been changed by another process.
+
+        '''
+
+        cached = getattr(self, '_v_cdf', None)
+        if (cached is not None and cached[0] == committer.generation
+                and volatile_caches()):
+            return cached[1], cached[2]
 
         action_names = self.actions()
         weights = [self._action_weights[meth_name] for meth_name in action_names]
         total = float(sum(weights))
-        cum_norm_weights = [0.0]*len(weights)
-        for i in xrange(len(weights)):
-            cum_norm_weights[i] = cum_norm_weights[i-1] + weights[i]/total
-        meth_name = action_names[bisect(cum_norm_weights, random.random())]
+        cum_norm_weights = []
+        cum = 0.0
+        for weight in weights:
+            cum += weight/total
+            cum_norm_weights.append(cum)
+
+        self._v_cdf = (committer.generation, action_names, cum_norm_weights)
+        return action_names, cum_norm_weights
+
+    def action(self):
+        'Select a possible action using weighted choice'
+
+        action_names, cum_norm_weights = self._cdf()
+        i = bisect(cum_norm_weights, random.random())
+        meth_name = action_names[min(i, len(action_names)-1)]
         return getattr(self, meth_name)
 
     def act(self):
@@ -230,23 +269,25 @@ Mob: %s (%s) [in room %s]: %s
         if not self.exists():
             return
 
+        # no one is near enough to notice anything this mob does
+        if not interest.is_observed(self.room):
+            interest.sleep(self)
+            return
+
         action = self.action()
+        savepoint = committer.savepoint()
         try:
             if self.awake or action == self.action_awake:
                 action()
 
             self._last_act = time.time()
 
-        except:
-            #print 'mob.act ABORT'
-            abort()
+        except Exception, e:
+            #print 'mob.act ROLLBACK'
+            savepoint.rollback(e)
             #raise
 
-        else:
-            #print 'mob.act COMMIT'
-            commit()
-
-        reactor.callLater(self.period, self.act)
+        scheduler.schedule(self, self.period, 'act')
 
     def nudge(self, delayfactor=10):
         'Make sure the mob is calling act() regularly.'
@@ -254,10 +295,33 @@ Mob: %s (%s) [in room %s]: %s
         now = time.time()
 
         if now > self._last_act + self.period * delayfactor:
-            reactor.callLater(self.period, self.act)
+            scheduler.schedule(self, self.period, 'act')
         else:
             print 'Mob acted too recently to nudge.'
 
+    def catch_up(self, elapsed):
+        '''This mob has been dormant for elapsed seconds because no
+            player was near. Take some of the actions it would have
+            taken in that time (at most conf.aoi_catch_up of them).
+
+        Mobs which need to do something special to catch up (for
+            instance, to spawn everything they would have spawned)
+            can override this.
+
+        '''
+
+        n = min(int(elapsed / max(self.period, 1)), conf.aoi_catch_up)
+        for i in range(n):
+            action = self.action()
+            savepoint = committer.savepoint()
+            try:
+                if self.awake or action == self.action_awake:
+                    action()
+            except Exception, e:
+                savepoint.rollback(e)
+
+        self._last_act = time.time()
+
 
     def action_sleep(self):
         'Go to sleep.'
@@ -88,18 +88,18 @@ def ls():
 def names():
     'Return a list of the names of all the players.'
 
-    k = dbroot['players'].keys()
+    k = list(dbroot['players'].keys())
     k.remove('_index')
     return k
 
 def isplayer(obj):
-    return obj in ls()
+    return get(getattr(obj, 'tzid', None)) is obj
 
 
 class Player(Character):
     'Base class for all players.'
 
-    name = str_attr('name', blank_ok=False, setonce=True)
+    name = str_attr('name', blank_ok=False, setonce=True, indexed=True)
     _bse = 'Player'
 
     def __init__(self, name, short='', long=''):
@@ -685,5 +685,17 @@ class Player(Character):
                     self.message(user, 'uses the', item, 'on', target, '.')
 
 
+def upgrade(from_version, to_version):
+    if from_version==7 and to_version==8:
+        print '  giving roles to wizards and admins'
+        for role in 'wizard', 'admin':
+            for name in dbroot[role]:
+                player = getname(name)
+                if player is not None:
+                    player.add_role(role)
+                else:
+                    print '    no player named', name
+
+
 if __name__ == '__main__':
     update()
@@ -28,12 +28,13 @@ for mobs. It works out best to keep these object types separated.
 import time
 import copy
 import random
+from collections import deque
 
 from twisted.internet import reactor
 
 from persistent.list import PersistentList
 
-from db import TZODB, TZIndex
+from db import TZODB, TZIndex, TZNameIndex, TZLinkIndex, TZCommitter
 zodb = TZODB()
 dbroot = zodb.root
 commit = zodb.commit
@@ -44,16 +45,28 @@ import mobs
 import items
 import players
 from share import TZContainer, TZObj, class_as_string, int_attr, str_list_attr
+from share import TZIdSet, volatile_caches
 from share import register_plugin
 from colors import green, yellow, red
 
 tzindex = TZIndex()
+nameindex = TZNameIndex()
+linkindex = TZLinkIndex()
+committer = TZCommitter()
+
+from scheduler import TZScheduler, TZInterest
+scheduler = TZScheduler()
+interest = TZInterest()
 
 
 def get(rid):
     'Return the room with the given id number.'
 
-    return dbroot['rooms'].get(rid, None)
+    try:
+        return dbroot['rooms'].get(rid, None)
+    except TypeError:
+        # not an id number. (None, for instance)
+        return None
 
 def add(room):
     'Add the given room to the database.'
@@ -76,8 +89,9 @@ def getname(name, all=False):
     '''
 
     result = []
-    for room in ls():
-        if room.name == name or name in room.name_aka:
+    for tzid in nameindex.lookup(name):
+        room = get(tzid)
+        if room is not None:
             if not all:
                 return room
             else:
@@ -91,7 +105,7 @@ def getname(name, all=False):
 def ls():
     'Return a list of all the rooms in the database.'
 
-    return dbroot['rooms'].values()
+    return list(dbroot['rooms'].values())
 
 def names():
     '''Return a list of the names of all the rooms in the database.
@@ -104,7 +118,7 @@ def names():
     return [room.name for room in dbroot['rooms'].values()]
 
 def isroom(obj):
-    return obj in ls()
+    return get(getattr(obj, 'tzid', None)) is obj
 
 
 def nudge_all():
@@ -124,6 +138,18 @@ class Room(TZContainer):
     name_aka = ['room']
     period = int_attr('period') # seconds
     _bse = 'Room'
+    _defaults = {'_exit_ids': TZIdSet,
+                    '_player_ids': TZIdSet,
+                    '_mob_ids': TZIdSet}
+    _near_tables = True
+
+    # Rooms with simulated = True get simulate(dt) instead of periodic()
+    #   and are run by the scheduler in priority order. When the server
+    #   is overloaded, rooms with a sim_priority below
+    #   conf.sim_shed_priority are put off until later. See
+    #   TZScheduler._simulate
+    simulated = False
+    sim_priority = 1
 
     def __init__(self, name='', short='', long='', owner=None,
                     exits=None, items=None):
@@ -131,12 +157,12 @@ class Room(TZContainer):
 
         self.settings.append('period')
 
-        self._exit_ids = PersistentList()
+        self._exit_ids = TZIdSet()
         if exits is not None:
             for x in exits:
                 self.addexit(x)
-        self._player_ids = PersistentList()
-        self._mob_ids = PersistentList()
+        self._player_ids = TZIdSet()
+        self._mob_ids = TZIdSet()
 
         self._last_periodic = 0
 
@@ -192,13 +218,33 @@ class Room(TZContainer):
         '''
 
         if self.period:
-            self.periodic()
-            self._last_periodic = time.time()
-            reactor.callLater(self.period, self.periodically)
+            now = time.time()
+            if self.simulated:
+                last = self._last_periodic or now
+                committer.guard(self.simulate, now - last)
+            else:
+                committer.guard(self.periodic)
+            self._last_periodic = now
+            scheduler.schedule(self, self.period, 'periodically')
 
     def periodic(self):
         pass
 
+    def simulate(self, dt):
+        '''Bring the room forward by dt seconds.
+
+        Only called for rooms with simulated = True. dt is the time since
+            the last call (0 the first time) and may be longer than the
+            period if the room was put off because the server was busy,
+            so anything that depends on how much time has passed should
+            use dt instead of assuming one period.
+
+        By default just calls periodic().
+
+        '''
+
+        self.periodic()
+
     def nudge(self, delayfactor=10):
         'Nudge this room to make sure the periodic calls are happening.'
 
@@ -223,6 +269,20 @@ class Room(TZContainer):
             actor=<character>. Different actions can pass whatever other
             information deemed necessary through the info dict.
 
+        If info['spread'] is set, the action also goes to the rooms that
+            many exits away (see _spread()). Those rooms get it through
+            act_near(), not action().
+
+        The action only goes to the objects which want it (see
+            subscribers()). To narrow it down further, set info['only']:
+
+            'characters' only the players and mobs in the room get the
+                            action (and the items they carry, if those
+                            want it).
+            'listeners'  only the objects in the room which handle the
+                            action themselves get it. It is not passed
+                            on to anything they carry.
+
         '''
 
         #delay = info.get('delay', 0.1)
@@ -231,8 +291,17 @@ class Room(TZContainer):
         #raise SyntaxError
 
     def _action(self, info):
-        'Actual action work is done here.'
+        '''Actual action work is done here.
 
+        The action runs in its own savepoint, along with any spread to
+            nearby rooms. If anything goes wrong only the changes made
+            by this action are rolled back, and the changes are
+            committed along with the rest of the work done in this pass
+            through the reactor loop.
+
+        '''
+
+        savepoint = committer.savepoint()
         try:
             self.act_near(info)
 
@@ -240,32 +309,53 @@ class Room(TZContainer):
             # this action, find the rooms from the exits and pass it on.
             spread = info.get('spread', None)
             if spread is not None and spread > 0:
-                fromroom = info.get('fromroom', None)
-                info['fromroom'] = self
-                info['spread'] -= 1
-                for x in self.exits():
-                    room = x.destination
-                    if room == fromroom:
-                        continue
-                    for bx in room.exits():
-                        if bx.destination == self:
-                            info['fromx'] = bx
-                            break
-                    # EEE -- Could calling this here be a transaction problem?
-                    room.action(info)
+                self._spread(info)
 
         except Exception, e:
-            print 'room._action ABORT'
+            print 'room._action ROLLBACK'
             for line in e:
                 print line
             import traceback
             print traceback.format_exc()
-            abort()
+            savepoint.rollback(e)
             #raise
 
-        else:
-            #print 'room._action COMMIT'
-            commit()
+    def _spread(self, info):
+        '''Pass the action on to the rooms within info['spread'] exits
+            of this room.
+
+        The rooms are visited breadth first, so each room gets the action
+            once, from the nearest room to this one. Each room gets its
+            own copy of info with fromroom (the room it came from), fromx
+            (the exit leading back that way) and spread (how much further
+            it will go) set for that room.
+
+        No more than conf.spread_max_rooms rooms (counting this one) get
+            the action.
+
+        '''
+
+        limit = conf.spread_max_rooms
+        visited = set([self.tzid])
+        queue = deque([(self, info['spread'])])
+        while queue:
+            room, spread = queue.popleft()
+            for x in room.exits():
+                dest = x.destination
+                if dest is None or dest.tzid in visited:
+                    continue
+                elif len(visited) >= limit:
+                    return
+                visited.add(dest.tzid)
+
+                hop = dict(info)
+                hop['fromroom'] = room
+                hop['fromx'] = dest.exitto(room)
+                hop['spread'] = spread - 1
+                dest.act_near(hop)
+
+                if spread > 1:
+                    queue.append((dest, spread - 1))
 
     def act_near(self, info):
         '''Something has happened in this room. Handle it if necessary,
@@ -275,17 +365,77 @@ class Room(TZContainer):
 
         TZObj.act_near(self, info)
 
-        for player in self.players():
-            player.act_near(info)
+        only = info.get('only', None)
+        for obj in self.subscribers(info['act'], only):
+            if tzindex.get(obj.tzid) is not obj:
+                # destroyed by an earlier handler
+                continue
+            elif only == 'listeners' and not obj.__class__._near_any:
+                TZObj.act_near(obj, info)
+            else:
+                obj.act_near(info)
 
-        for mob in self.mobs():
-            mob.act_near(info)
+    def subscribers(self, act, only=None):
+        '''Return a list of the players, mobs, items and exits in this
+            room which want the given act, in that order.
 
-        for item in self.items():
-            item.act_near(info)
+        See action() for the values of only.
 
-        for x in self.exits():
-            x.act_near(info)
+        The id numbers of the subscribers for each act are kept in a
+            volatile attribute, so working out who wants an act only
+            happens once. The lists are thrown away when anything
+            enters or leaves the room, when anything is added to or
+            removed from something in the room, or when changes are
+            rolled back. If volatile_caches() is False, they are worked
+            out every time.
+
+        Anything which has been destroyed since the list was made is
+            left out.
+
+        '''
+
+        stamp = (committer.generation,
+                    self._player_ids.stamp(), self._mob_ids.stamp(),
+                    self._item_ids.stamp(), self._exit_ids.stamp())
+
+        subs = getattr(self, '_v_subs', None)
+        if subs is None or subs[0] != stamp or not volatile_caches():
+            subs = (stamp, {})
+            self._v_subs = subs
+
+        key = (act, only)
+        tzids = subs[1].get(key)
+        if tzids is None:
+            groups = [self._player_ids, self._mob_ids]
+            if only != 'characters':
+                groups.extend([self._item_ids, self._exit_ids])
+
+            tzids = []
+            for ids in groups:
+                for tzid in ids:
+                    obj = tzindex.get(tzid)
+                    if obj is None:
+                        continue
+                    elif only == 'listeners':
+                        wanted = TZObj.wants(obj, act)
+                    else:
+                        wanted = obj.wants(act)
+                    if wanted:
+                        tzids.append(tzid)
+            subs[1][key] = tzids
+
+        result = []
+        for tzid in tzids:
+            obj = tzindex.get(tzid)
+            if obj is not None:
+                result.append(obj)
+        return result
+
+    def _forget_acts(self):
+        'Throw away the cached set of acts and the subscriber lists.'
+
+        TZContainer._forget_acts(self)
+        self._v_subs = None
 
     def players(self):
         'Return a list of all the players in this room'
@@ -318,25 +468,24 @@ class Room(TZContainer):
 
         '''
 
-        for player in self.players():
-            if player.name == name:
-                if not all:
-                    return player
-                else:
-                    return [player]
-        return None
+        return self._findname('_player_ids', name, all,
+                                akas=False, articles=False)
 
     def addplayer(self, player):
         'Put the given player in this room.'
 
         self._player_ids.append(player.tzid)
         player.container = self
+        self._names_changed('_player_ids')
+        interest.changed()
 
     def rmplayer(self, player):
         'Remove the given player from this room.'
 
         self._player_ids.remove(player.tzid)
         player.container = None
+        self._names_changed('_player_ids')
+        interest.changed()
 
 
     def mobs(self):
@@ -377,50 +526,21 @@ class Room(TZContainer):
 
         '''
 
-        result = set()
-        for mob in self.mobs():
-            if mob.name == name:
-                if not all:
-                    return mob
-                else:
-                    result.add(mob)
-
-        for mob in self.mobs():
-            if hasattr(mob, 'name_aka'):
-                for aka in mob.name_aka:
-                    if aka == name:
-                        if not all:
-                            return mob
-                        else:
-                            result.add(mob)
-
-        for article in ('a ', 'an ', 'the '):
-            if name.startswith(article):
-                l = len(article)
-                aname = name[l:]
-                with_article = self.mobname(aname, all)
-                if with_article is not None:
-                    if not all:
-                        return with_article
-                    else:
-                        result.add(with_article)
-
-        if result:
-            return list(result)
-        else:
-            return None
+        return self._findname('_mob_ids', name, all)
 
     def addmob(self, mob):
         'Move the given mob to this room.'
 
         self._mob_ids.append(mob.tzid)
         mob.container = self
+        self._names_changed('_mob_ids')
 
     def rmmob(self, mob):
         'Remove the given mob from this room.'
 
         self._mob_ids.remove(mob.tzid)
         mob.container = None
+        self._names_changed('_mob_ids')
 
 
     def exits(self):
@@ -428,6 +548,18 @@ class Room(TZContainer):
 
         return [tzindex.get(xid) for xid in self._exit_ids]
 
+    def exitto(self, destination):
+        '''Return an exit from this room which leads to destination,
+            or None if there is no such exit.
+
+        '''
+
+        for xid in linkindex.lookup(self.tzid, destination.tzid):
+            x = tzindex.get(xid)
+            if x is not None and xid in self._exit_ids:
+                return x
+        return None
+
     def exitnames(self):
         'Return a list of the names of all the exits from this room.'
 
@@ -462,38 +594,7 @@ class Room(TZContainer):
 
         '''
 
-        result = set()
-        for x in self.exits():
-            if x.name == name:
-                if not all:
-                    return x
-                else:
-                    result.add(x)
-
-        for x in self.exits():
-            if hasattr(x, 'name_aka'):
-                for aka in x.name_aka:
-                    if aka == name:
-                        if not all:
-                            return x
-                        else:
-                            result.add(x)
-
-        for article in ('a ', 'an ', 'the '):
-            if name.startswith(article):
-                l = len(article)
-                aname = name[l:]
-                with_article = self.exitname(aname, all)
-                if with_article is not None:
-                    if not all:
-                        return with_article
-                    else:
-                        result.add(with_article)
-
-        if result:
-            return list(result)
-        else:
-            return None
+        return self._findname('_exit_ids', name, all)
 
     def addexit(self, x):
         'Put an exit in this room.'
@@ -501,6 +602,7 @@ class Room(TZContainer):
         self._exit_ids.append(x.tzid)
         x.room = self
         x.container = self
+        self._names_changed('_exit_ids')
 
     def rmexit(self, x):
         'Remove an exit from this room.'
@@ -508,6 +610,7 @@ class Room(TZContainer):
         self._exit_ids.remove(x.tzid)
         x.room = None
         x.container = None
+        self._names_changed('_exit_ids')
 
 
     def look(self, looker):
@@ -679,7 +782,7 @@ class TimedTrap(Room):
     def near_arrive(self, info):
         if not self._springing:
             self._springing = time.time()
-            reactor.callLater(self.timer, self.spring_trap)
+            reactor.callLater(self.timer, committer.guard, self.spring_trap)
 
     def spring_trap(self):
         self._springing = False
@@ -709,6 +812,7 @@ class TeleTrap(TimedTrap):
         self.near_arrive(info)
 
     def spring_trap(self):
+        savepoint = committer.savepoint()
         try:
             TimedTrap.spring_trap(self)
 
@@ -734,11 +838,8 @@ class TeleTrap(TimedTrap):
                 for c in p:
                     c.message('Nothing happens...')
 
-        except:
-            abort()
-
-        else:
-            commit()
+        except Exception, e:
+            savepoint.rollback(e)
 
 
 class Zoo(Room):
@@ -756,6 +857,8 @@ class Zoo(Room):
     name = 'zoo'
     short = 'All sorts of strange creatures.'
     period = 3600 # 60 minutes
+    simulated = True
+    sim_priority = 0
 
     def destroy(self):
         '''Get rid of the Zoo.
@@ -787,15 +890,32 @@ class Zoo(Room):
 
         self.populate()
 
-    def populate(self):
+    def simulate(self, dt):
+        '''Check to see the zoo has all of its inhabitants.
+
+        dt is the time since the last check. See populate().
+
+        '''
+
+        self.populate(dt)
+
+    def populate(self, dt=None):
         '''If the Zoo has an area for a mob, check that the mob is still
             there and if not, respawn it.
 
         If the Zoo does not have an area for the mob, it may be a new mob,
             so build a place for it.
 
+        If there is no key in the zoo, a new one turns up about once
+            every 50 periods. dt is the time since the last check (one
+            period if not given) so the chance stays the same even when
+            checks are put off.
+
         '''
 
+        if dt is None:
+            dt = self.period
+
         key = self.itemname('key')
         if key is None:
             # Check if the room has any keys. If not make one.
@@ -804,7 +924,8 @@ class Zoo(Room):
             _key = None
             if hasattr(self, '_key'):
                 _key = getattr(self, '_key')
-            if _key is None or random.choice(random.randrange(50)) == 0:
+            chance = 1 - (49/50.0) ** (dt / float(max(self.period, 1)))
+            if _key is None or random.random() < chance:
                 key = items.Key()
                 self.add(key)
                 # make sure to always use the same key
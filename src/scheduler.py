@@ -0,0 +1,675 @@
+# Copyright 2008 Lee Harr
+#
+# This file is part of TZMud.
+#
+# TZMud is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# TZMud is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TZMud.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Runs the timed actions of mobs and rooms.
+
+Instead of every mob and room keeping its own reactor.callLater, all
+    of them are kept in one hashed timer wheel: a ring of
+    conf.scheduler_slots slots, each conf.scheduler_tick seconds long.
+    An action due in d seconds goes in the slot d/tick ahead of the
+    current one (wrapping around the ring, so a slot may hold actions
+    for several trips around).
+
+A single LoopingCall moves the wheel on one slot per tick and runs all
+    of the actions which have come due, one after another, in the same
+    pass through the reactor loop, so they are all committed together
+    in a single transaction. Each action runs in its own savepoint, so
+    an action which fails is rolled back without affecting the rest.
+
+Actions are kept by object id number and method name, so an object
+    which has been destroyed in the meantime is simply skipped, and
+    scheduling the same method again replaces the earlier entry
+    instead of adding a second one.
+
+Mobs far away from every player do not need to act at all, since no
+    one could see what they do. TZInterest keeps track of the rooms
+    within conf.aoi_radius exits of a logged in player. A mob outside
+    of those rooms goes dormant: it is taken off the wheel entirely
+    until a player comes near, then it catches up on the time it
+    missed (see Mob.catch_up) and starts acting again. The work done
+    by the scheduler grows with the number of players, not with the
+    number of mobs.
+
+The time each call is due is also kept in the database (see TZSchedule)
+    so that when the server starts, the wheel can be filled again
+    without loading every mob and room. The wheel only ever holds the
+    calls due in the next conf.scheduler_horizon seconds. Calls due
+    later are read from the database a little at a time as their time
+    comes near.
+
+'''
+
+
+import time
+import math
+import random
+import traceback
+
+from twisted.internet import task
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree, OOTreeSet
+
+import conf
+
+from db import TZODB, TZIndex, TZCommitter
+dbroot = TZODB().root
+tzindex = TZIndex()
+committer = TZCommitter()
+
+
+class TZSchedule(Persistent):
+    '''The calls waiting to be made by the scheduler, kept in the database
+        as dbroot['_schedule'].
+
+    Each call is kept as (due, tzid, method name) in a sorted set, so the
+        calls which will be due soon can be read without reading the
+        rest. due is in whole seconds since the epoch.
+
+    '''
+
+    def __init__(self):
+        self._queue = OOTreeSet() # (due, tzid, method)
+        self._due = OOBTree() # (tzid, method) --> due
+
+    def __len__(self):
+        return len(self._due)
+
+    def add(self, key, due):
+        '''Remember that the call key = (tzid, method) is due at the given
+            time, replacing any earlier time for the same call.
+
+        '''
+
+        old = self._due.get(key)
+        if old == due:
+            return
+        elif old is not None:
+            self._queue.remove((old,) + key)
+        self._due[key] = due
+        self._queue.insert((due,) + key)
+
+    def remove(self, key):
+        'Forget the call key = (tzid, method) if it is here.'
+
+        old = self._due.get(key)
+        if old is not None:
+            del self._due[key]
+            self._queue.remove((old,) + key)
+
+    def upto(self, until, after=None):
+        '''Return an iterator over the (due, tzid, method) entries which
+            are due before the time until, starting after the entry
+            given as after (or at the start if after is None).
+
+        '''
+
+        if after is None:
+            return iter(self._queue.keys(None, (until,)))
+        else:
+            return iter(self._queue.keys(after, (until,), excludemin=True))
+
+
+def store():
+    '''Return the TZSchedule kept in the database, or None if the
+        database has not been upgraded to have one yet.
+
+    '''
+
+    return dbroot.get('_schedule')
+
+def seed(schedule):
+    '''Add a call for every mob and every room with a period to the
+        given TZSchedule. The calls are spread out over one period so
+        that they do not all come at once.
+
+    Used when making a new database, when upgrading to a database which
+        keeps a schedule, and after importing objects.
+
+    '''
+
+    import transaction
+
+    now = time.time()
+    n = 0
+    for kind, method in ('mobs', 'act'), ('rooms', 'periodically'):
+        for obj in dbroot[kind].values():
+            period = obj.period
+            if period:
+                due = int(math.ceil(now + random.uniform(0, period)))
+                schedule.add((obj.tzid, method), due)
+                n += 1
+                if n % 1000 == 0:
+                    transaction.savepoint(True)
+            obj._p_deactivate()
+    return n
+
+
+class TZScheduler(object):
+    'Timer wheel for mobs and rooms. A Borg object with shared state.'
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self):
+        if not hasattr(self, 'wheel'):
+            self.tick = conf.scheduler_tick
+            self.slots = conf.scheduler_slots
+            self.wheel = [[] for i in range(self.slots)]
+            self.due = {} # (tzid, method name) --> tick it is due
+            self.ticks = 0 # number of ticks done so far
+            self.started = None
+            self.loop = None
+            self.loaded = None # last entry read from the TZSchedule
+            self.loads = 0
+            self.rescanned = time.time()
+            self.rescans = 0
+            self.simulated = 0
+            self.shed = 0
+            self.deferred = {} # room tzid --> time it was first put off
+
+            self.fired = 0
+            self.errors = 0
+            self.lag = 0.0
+            self.max_lag = 0.0
+            self.last_batch = 0
+            self.max_batch = 0
+
+    def start(self):
+        'Start moving the wheel.'
+
+        if self.loop is None:
+            self.started = time.time() - self.ticks * self.tick
+            # Run one tick right away, without the guard in _tick. If
+            #   anything is wrong it shows up here, at startup.
+            self._advance()
+            self.loop = task.LoopingCall(self._tick)
+            self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        'Stop moving the wheel. Scheduled actions are kept.'
+
+        if self.loop is not None:
+            self.loop.stop()
+            self.loop = None
+
+    def ticks_for(self, delay):
+        'Return the number of ticks in delay seconds (at least 1).'
+
+        return max(1, int(math.ceil(delay / self.tick)))
+
+    def schedule(self, obj, delay, method):
+        '''Call obj.<method>() in delay seconds.
+
+        Replaces any call of the same method on the same object which
+            was already scheduled.
+
+        The call goes on the wheel only if it is due within
+            conf.scheduler_horizon seconds. Later calls are only kept in
+            the TZSchedule, and _load() puts them on the wheel when
+            their time comes near.
+
+        '''
+
+        key = (obj.tzid, method)
+        schedule = store()
+        if schedule is None or delay <= conf.scheduler_horizon:
+            self._add(key, self.ticks + self.ticks_for(delay))
+        else:
+            self.due.pop(key, None)
+
+        if schedule is not None:
+            schedule.add(key, int(math.ceil(time.time() + delay)))
+
+    def _add(self, key, due):
+        'Put the call key on the wheel for tick number due.'
+
+        self.due[key] = due
+        self.wheel[due % self.slots].append((due, key))
+
+    def cancel(self, obj, method):
+        'Cancel the scheduled call of obj.<method>(), if there is one.'
+
+        key = (obj.tzid, method)
+        self.due.pop(key, None)
+
+        schedule = store()
+        if schedule is not None:
+            schedule.remove(key)
+
+    def park(self, obj, method, delay):
+        '''Take obj.<method>() off the wheel, but keep it in the database
+            as due in delay seconds, so that it will be called after the
+            server is restarted.
+
+        While the server keeps running, the call will not be read back
+            from the database until it is scheduled again.
+
+        '''
+
+        key = (obj.tzid, method)
+        self.due.pop(key, None)
+
+        schedule = store()
+        if schedule is not None:
+            schedule.add(key, int(math.ceil(time.time() + delay)))
+
+    def _load(self):
+        '''Read calls that will be due within conf.scheduler_horizon
+            seconds from the database and put them on the wheel.
+
+        Reads at most conf.scheduler_load calls each time, so that if
+            many calls are overdue (after the server was down for a
+            while) they are spread over several ticks.
+
+        '''
+
+        schedule = store()
+        if schedule is None:
+            return
+
+        now = time.time()
+        until = int(now + conf.scheduler_horizon)
+        n = 0
+        for entry in schedule.upto(until, self.loaded):
+            self.loaded = entry
+            due, tzid, method = entry
+            key = (tzid, method)
+            if key not in self.due and not TZInterest().is_dormant_id(tzid):
+                self._add(key, self.ticks + self.ticks_for(due - now))
+                self.loads += 1
+            n += 1
+            if n >= conf.scheduler_load:
+                break
+
+    def rescan(self):
+        '''Read the TZSchedule again from the start on the next _load().
+
+        The TZSchedule is what counts. Calls which are already on the
+            wheel are skipped, so this only picks up calls which were
+            missed: calls which ran in a transaction that was then
+            aborted (and so are back in the database as they were) or
+            calls which were changed by another process.
+
+        Done after an aborted tick, and every conf.scheduler_rescan
+            seconds in any case.
+
+        '''
+
+        self.loaded = None
+        self.rescanned = time.time()
+        self.rescans += 1
+
+    def scheduled(self, obj, method):
+        'Return True if a call to obj.<method>() is scheduled.'
+
+        key = (obj.tzid, method)
+        if key in self.due:
+            return True
+        schedule = store()
+        return schedule is not None and key in schedule._due
+
+    def _tick(self):
+        '''Called by the LoopingCall once per tick.
+
+        An error in _advance() would stop the LoopingCall, and with it
+            every mob and room, so errors are counted and printed here
+            instead, and the wheel carries on with the next tick.
+
+        '''
+
+        try:
+            self._advance()
+        except:
+            self.errors += 1
+            traceback.print_exc()
+
+    def _advance(self):
+        '''Move the wheel on to the current time and run everything that
+            has come due.
+
+        If the reactor was held up for more than one tick, all of the
+            ticks that were missed are caught up at once.
+
+        '''
+
+        now = time.time()
+        if now - self.rescanned >= conf.scheduler_rescan:
+            self.rescan()
+
+        TZInterest().update()
+        self._load()
+
+        target = int((now - self.started) / self.tick)
+        self.lag = max(0.0, now - (self.started + (self.ticks+1)*self.tick))
+        self.max_lag = max(self.max_lag, self.lag)
+
+        batch = []
+        while self.ticks < target:
+            self.ticks += 1
+            n = self.ticks % self.slots
+            waiting = []
+            for due, key in self.wheel[n]:
+                if self.due.get(key) != due:
+                    # cancelled or scheduled again for another time
+                    continue
+                elif due <= self.ticks:
+                    del self.due[key]
+                    batch.append(key)
+                else:
+                    waiting.append((due, key))
+            self.wheel[n] = waiting
+
+        # take the calls out of the database first. Most of them will
+        #   put themselves back in with a new time when they run.
+        schedule = store()
+        if schedule is not None:
+            for key in batch:
+                schedule.remove(key)
+            if batch:
+                # if the transaction is aborted, the calls go back in the
+                #   database as they were, behind the cursor.
+                committer.after_abort(self.rescan)
+
+        sims = []
+        for tzid, method in batch:
+            obj = tzindex.get(tzid)
+            if obj is None:
+                continue
+            elif getattr(obj.__class__, 'simulated', False):
+                sims.append(obj)
+                continue
+            self._run(obj, method)
+
+        self._simulate(sims, now)
+
+        self.fired += len(batch)
+        self.last_batch = len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+
+        if batch:
+            committer.request()
+
+    def _run(self, obj, method):
+        'Call obj.<method>() in its own savepoint.'
+
+        try:
+            committer.run(getattr(obj, method))
+        except:
+            self.errors += 1
+            traceback.print_exc()
+
+    def overloaded(self, started):
+        '''Return True if the server is too busy to do low priority work.
+
+        That is when the tick ran more than conf.sim_overload_lag seconds
+            late, or this tick (which started at started) has already
+            taken more than conf.sim_budget seconds.
+
+        '''
+
+        return (self.lag > conf.sim_overload_lag or
+                    time.time() - started > conf.sim_budget)
+
+    def _simulate(self, sims, started):
+        '''Run the simulated rooms that have come due, highest
+            sim_priority first.
+
+        When the server is overloaded, rooms with a sim_priority below
+            conf.sim_shed_priority are put off for conf.sim_shed_delay
+            seconds. Each room works out for itself how much time has
+            passed when it does run (see Room.simulate) so nothing is
+            lost by putting it off, and since its call is simply moved
+            to a later time it cannot run twice. A room which has been
+            put off for conf.sim_shed_max seconds runs anyway, so that
+            every room runs eventually.
+
+        '''
+
+        now = time.time()
+        sims.sort(key=lambda room: room.__class__.sim_priority, reverse=True)
+        for room in sims:
+            since = self.deferred.get(room.tzid, now)
+            if (room.__class__.sim_priority < conf.sim_shed_priority and
+                        now - since < conf.sim_shed_max and
+                        self.overloaded(started)):
+                self.schedule(room, conf.sim_shed_delay, 'periodically')
+                self.deferred[room.tzid] = since
+                self.shed += 1
+            else:
+                self.deferred.pop(room.tzid, None)
+                self._run(room, 'periodically')
+                self.simulated += 1
+
+    def stats(self):
+        '''Return a dict with information about the scheduler.
+
+        queued is the number of calls waiting to be made, lag is how
+            late (in seconds) the last tick ran.
+
+        '''
+
+        interest = TZInterest()
+
+        schedule = store()
+        if schedule is not None:
+            stored = len(schedule)
+        else:
+            stored = None
+
+        return dict(queued=len(self.due),
+                    stored=stored,
+                    loads=self.loads,
+                    rescans=self.rescans,
+                    simulated=self.simulated,
+                    shed=self.shed,
+                    observed=len(interest.observed),
+                    dormant=len(interest.dormant),
+                    ticks=self.ticks,
+                    tick=self.tick,
+                    slots=self.slots,
+                    running=self.loop is not None,
+                    fired=self.fired,
+                    errors=self.errors,
+                    lag=self.lag,
+                    max_lag=self.max_lag,
+                    last_batch=self.last_batch,
+                    max_batch=self.max_batch)
+
+
+class TZInterest(object):
+    '''Area of interest of the players. A Borg object with shared state.
+
+    observed is the set of id numbers of the rooms within
+        conf.aoi_radius exits of a logged in player. It is worked out
+        again on the next tick after any player enters or leaves a
+        room, or any exit is changed (see changed()) so it costs
+        nothing while the players stay put.
+
+    dormant maps the id number of each dormant mob to (room id, time
+        it went dormant) and sleepers maps each room id to the set of
+        dormant mobs in that room. Mob.move() calls moved() so that a
+        dormant mob which is moved is kept under the room it is in now.
+        When the observed rooms change, only the rooms which have just
+        become observed are checked for sleepers.
+
+    '''
+
+    _state = {}
+    def __new__(cls, *p, **k):
+        self = object.__new__(cls, *p, **k)
+        self.__dict__ = cls._state
+        return self
+
+    def __init__(self):
+        if not hasattr(self, 'observed'):
+            self.observed = set()
+            self.dirty = True
+            self.dormant = {}
+            self.sleepers = {}
+
+    def enabled(self):
+        'Return True if mobs far from players should go dormant.'
+
+        return conf.aoi_radius > 0
+
+    def changed(self):
+        'A player has entered or left a room, or an exit has changed.'
+
+        self.dirty = True
+
+    def is_observed(self, room):
+        '''Return True if the given room is close enough to a player that
+            what happens there matters.
+
+        '''
+
+        if not self.enabled():
+            return True
+        self.update()
+        return room is not None and room.tzid in self.observed
+
+    def update(self):
+        '''Work out the observed rooms again if any player has moved, and
+            wake up the dormant mobs in rooms which are now observed.
+
+        '''
+
+        if not self.dirty or not self.enabled():
+            return
+        self.dirty = False
+
+        import tzprotocol
+
+        factory = getattr(tzprotocol.TZ, 'factory', None)
+        clients = getattr(factory, 'clients', [])
+
+        observed = set()
+        for client in clients:
+            if not client.logged_in:
+                continue
+            player = getattr(client, 'player', None)
+            room = getattr(player, 'room', None)
+            if room is not None and room.tzid not in observed:
+                observed.update(self.near(room))
+        newly = observed - self.observed
+        self.observed = observed
+
+        for rid in newly:
+            if rid not in self.sleepers:
+                continue
+            for mid in list(self.sleepers[rid]):
+                mob = tzindex.get(mid)
+                if mob is not None:
+                    self.wake(mob)
+                else:
+                    self._forget(mid)
+
+    def near(self, room):
+        '''Return the set of id numbers of the rooms within conf.aoi_radius
+            exits of the given room.
+
+        '''
+
+        found = set([room.tzid])
+        edge = [room]
+        for hop in range(conf.aoi_radius):
+            nextedge = []
+            for r in edge:
+                for x in r.exits():
+                    dest = x.destination
+                    if dest is not None and dest.tzid not in found:
+                        found.add(dest.tzid)
+                        nextedge.append(dest)
+            edge = nextedge
+        return found
+
+    def sleep(self, mob):
+        '''Take the mob off the scheduler until a player comes near its
+            room.
+
+        '''
+
+        rid = getattr(mob.room, 'tzid', None)
+        self._forget(mob.tzid)
+        self.dormant[mob.tzid] = (rid, time.time())
+        self.sleepers.setdefault(rid, set()).add(mob.tzid)
+        TZScheduler().park(mob, 'act', mob.period)
+
+    def moved(self, mob, room):
+        '''The given mob has moved to room. If it is dormant, keep it
+            under its new room, and wake it up if that room is observed.
+
+        '''
+
+        entry = self.dormant.get(mob.tzid)
+        if entry is None:
+            return
+        rid, since = entry
+        newrid = getattr(room, 'tzid', None)
+        if newrid != rid:
+            self._forget(mob.tzid)
+            self.dormant[mob.tzid] = (newrid, since)
+            self.sleepers.setdefault(newrid, set()).add(mob.tzid)
+        if self.is_observed(room):
+            self.wake(mob)
+
+    def wake(self, mob):
+        '''Bring a dormant mob up to date and put it back on the
+            scheduler.
+
+        '''
+
+        entry = self._forget(mob.tzid)
+        if entry is None:
+            return
+        rid, since = entry
+        try:
+            committer.run(mob.catch_up, time.time() - since)
+        except:
+            traceback.print_exc()
+        TZScheduler().schedule(mob, mob.period, 'act')
+
+    def is_dormant(self, mob):
+        'Return True if the given mob is dormant.'
+
+        return mob.tzid in self.dormant
+
+    def is_dormant_id(self, tzid):
+        'Return True if the mob with the given id number is dormant.'
+
+        return tzid in self.dormant
+
+    def _forget(self, mid):
+        '''Mob mid is no longer dormant. Return (room id, time it went
+            dormant) or None if it was not dormant.
+
+        '''
+
+        entry = self.dormant.pop(mid, None)
+        if entry is not None:
+            rid, since = entry
+            sleepers = self.sleepers.get(rid)
+            if sleepers is not None:
+                sleepers.discard(mid)
+                if not sleepers:
+                    del self.sleepers[rid]
+        return entry
@@ -36,15 +36,41 @@ from twisted.internet import reactor
 from persistent import Persistent
 from persistent.list import PersistentList
 from persistent.dict import PersistentDict
+from BTrees.IIBTree import IIBTree
 
 import conf
-from db import TZODB, TZIndex
+from db import TZODB, TZIndex, TZNameIndex, TZCommitter, TZIdAllocator
+from db import normalize_name
 zodb = TZODB()
 dbroot = zodb.root
 abort = zodb.abort
 commit = zodb.commit
 
 tzindex = TZIndex()
+nameindex = TZNameIndex()
+committer = TZCommitter()
+tzidallocator = TZIdAllocator()
+
+# tzid --> number of times that object has changed container since
+#   _moves was last cleared. Used to check the cached container chains.
+#   See TZObj._chain(). Cleared when it gets to _moves_max entries, and
+#   _moves_epoch goes up so that all of the cached chains are made again.
+_moves = {}
+_moves_max = 10000
+_moves_epoch = 0
+
+
+def volatile_caches():
+    '''Return True if values worked out from the database can be kept
+        in volatile (_v_) attributes.
+
+    Those values are only checked against changes made in this process,
+        so they cannot be used when other processes share the database
+        (conf.storage = 'zeo').
+
+    '''
+
+    return conf.storage != 'zeo'
 
 
 
@@ -81,8 +107,36 @@ def bool_attr(name, default=False):
 class SetOnceError(ValueError):
     pass
 
-def str_attr(name, default='', blank_ok=True, setonce=False):
-    'An attribute that will always hold a string.'
+def _name_indexed(obj):
+    '''Return True if the names of the given object are kept in
+        the name index. Objects are not indexed until they have
+        been added to the main index.
+
+    '''
+
+    tzid = getattr(obj, 'tzid', None)
+    return tzid is not None and tzindex.get(tzid) is obj
+
+def names_changed(obj):
+    '''The name or other names of the given object have changed. The
+        name maps of all containers (see TZContainer._namemap) will be
+        made again the next time they are needed.
+
+    Objects which are not indexed yet (still being created) cannot be
+        in any name map, so nothing is done for them.
+
+    '''
+
+    if _name_indexed(obj):
+        nameindex.changed()
+
+def str_attr(name, default='', blank_ok=True, setonce=False, indexed=False):
+    '''An attribute that will always hold a string.
+
+    If indexed is True, the value is the main name of the object and
+        the name index is updated whenever the value changes.
+
+    '''
 
     varname = '_%s' % name
     def getter(self, var=varname):
@@ -92,7 +146,12 @@ def str_attr(name, default='', blank_ok=True, setonce=False):
             if val=='' and not blank_ok:
                 raise ValueError, 'Blank string not allowed.'
             val = unicode(val)
+            oldval = getattr(self, var, None)
             setattr(self, var, val)
+            if indexed and oldval != val:
+                if _name_indexed(self):
+                    nameindex.rename(self, oldval, val)
+                names_changed(self)
     else:
         def setter(self, val, var=varname):
             if val=='' and not blank_ok:
@@ -101,13 +160,22 @@ def str_attr(name, default='', blank_ok=True, setonce=False):
             if not ival:
                 val = str(val)
                 setattr(self, var, val)
+                if indexed:
+                    if _name_indexed(self):
+                        nameindex.rename(self, None, val)
+                    names_changed(self)
             else:
                 raise SetOnceError, 'Cannot be changed once set.'
 
     return property(getter, setter)
 
-def str_list_attr(name):
-    'An attribute that will always hold a list of strings.'
+def str_list_attr(name, indexed=False):
+    '''An attribute that will always hold a list of strings.
+
+    If indexed is True, the values are other names for the object
+        and the name index is updated whenever the list changes.
+
+    '''
 
     varname = '_%s' % name
     def getter(self, var=varname):
@@ -124,30 +192,113 @@ def str_list_attr(name):
             sl = PersistentList()
             setattr(self, var, sl)
 
+        index = indexed and _name_indexed(self)
+
         if isinstance(val, list) or isinstance(val, PersistentList):
+            if index:
+                for v in sl:
+                    nameindex.rmaka(self, v)
             sl[:] = []
             for v in val:
                 sl.append(v)
+                if index:
+                    nameindex.addaka(self, v)
         elif not val.startswith('-DEL-'):
             if val not in sl:
                 sl.append(val)
+                if index:
+                    nameindex.addaka(self, val)
         else:
             val = val[5:]
             if val in sl:
                 sl.remove(val)
+                if index and val not in sl:
+                    nameindex.rmaka(self, val)
 
-        commit()
+        if indexed:
+            names_changed(self)
+
+        committer.request()
 
     return property(getter, setter)
 
 
+_created = None # see replace()
 def tzid():
-    'Increment the id counter and return the next available id number.'
+    '''Return the next available id number.
+
+    Id numbers are reserved from the counter in the database in blocks
+        of conf.tzid_block, so most calls do not touch the database.
 
-    previd = dbroot['share']['tzid']
-    nextid = previd + 1
-    dbroot['share']['tzid'] = nextid
-    return nextid
+    '''
+
+    n = tzidallocator.allocate()
+    if _created is not None:
+        _created.append(n)
+    return n
+
+
+class TZIdSet(Persistent):
+    '''An ordered set of id numbers.
+
+    Used to hold the ids of the objects in a container. Remembers the
+        order in which the ids were added (for display) but membership
+        tests, appends, and removes are O(log n), and a change only
+        writes the buckets that changed instead of the whole list.
+
+    '''
+
+    def __init__(self, tzids=()):
+        self._ids = IIBTree() # sequence number --> tzid
+        self._seqs = IIBTree() # tzid --> sequence number
+        self._next = 0
+        self._len = 0
+        for tzid in tzids:
+            self.append(tzid)
+
+    def __contains__(self, tzid):
+        try:
+            return tzid in self._seqs
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        return iter(self._ids.values())
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return 'TZIdSet(%s)' % list(self)
+
+    def append(self, tzid):
+        'Add the given id number at the end, if it is not already here.'
+
+        if tzid in self:
+            return
+        seq = self._next
+        self._next = seq + 1
+        self._ids[seq] = tzid
+        self._seqs[tzid] = seq
+        self._len += 1
+
+    def remove(self, tzid):
+        'Remove the given id number. Raises ValueError if it is not here.'
+
+        if tzid not in self:
+            raise ValueError, 'TZIdSet.remove(x): x not in set'
+        seq = self._seqs[tzid]
+        del self._seqs[tzid]
+        del self._ids[seq]
+        self._len -= 1
+
+    def stamp(self):
+        '''Return a value which changes whenever ids are added or removed
+            (including when a change is rolled back).
+
+        '''
+
+        return self._next, self._len
 
 
 class MetaTZObj(type):
@@ -236,6 +387,33 @@ class MetaTZObj(type):
 
         newcls = type.__new__(mcls, name, bases, dict)
         newcls._remember_settings = remember
+
+        # table of the handlers for nearby actions (near_<act> methods)
+        #   so that act_near does not need to look for the method, and
+        #   so that objects which do not handle an act can be skipped
+        #   without even being loaded from the database.
+        #
+        # a class which has its own act_near (other than the standard
+        #   ones, which set _near_tables) might do anything with any
+        #   act, so it must always be called.
+        handlers = {}
+        for attr in dir(newcls):
+            if attr.startswith('near_'):
+                method = getattr(newcls, attr)
+                handlers[attr[5:]] = getattr(method, 'im_func', method)
+        newcls._near_handlers = handlers
+        newcls._near_acts = frozenset(handlers)
+
+        near_any = 'act_near' in dict and not dict.get('_near_tables', False)
+        for base in bases:
+            if getattr(base, '_near_any', False):
+                near_any = True
+        newcls._near_any = near_any
+
+        # names of the action_* methods (used by mobs to pick an action)
+        newcls._action_names = tuple([attr for attr in dir(newcls)
+                                            if attr.startswith('action_')])
+
         return newcls
 
 
@@ -243,8 +421,9 @@ class TZObj(Persistent):
     'Base class for all MUD objects.'
 
     __metaclass__ = MetaTZObj
-    name = str_attr('name', default='proto obj', blank_ok=False)
-    name_aka = str_list_attr('name_aka')
+    _near_tables = True
+    name = str_attr('name', default='proto obj', blank_ok=False, indexed=True)
+    name_aka = str_list_attr('name_aka', indexed=True)
     short = str_attr('short')
     long = str_attr('long')
 
@@ -285,10 +464,12 @@ class TZObj(Persistent):
         self.container = container
 
         tzindex.add(self)
+        nameindex.add(self)
 
     def destroy(self):
         'Get rid of this object and remove it from the main index.'
 
+        nameindex.remove(self)
         tzindex.remove(self)
 
     def exists(self):
@@ -372,17 +553,25 @@ class TZObj(Persistent):
 
         .room is a read-only property that walks up the list of
             object.container attributes until it finds one that
-            is None.
+            is None. The walk uses the cached chain from _chain().
 
         '''
 
-        if self.container is None:
+        chain = self._chain()
+        if not chain:
             return None
-        else:
-            if self.container.room is None:
-                return self.container
-            else:
-                return self.container.room
+
+        # Characters keep track of their own room
+        for tzid in chain:
+            container = tzindex.get(tzid)
+            if isinstance(container, Character):
+                room = container.room
+                if room is None:
+                    return container
+                else:
+                    return room
+
+        return tzindex.get(chain[-1])
     room = property(_get_room)
 
     def set_visible(self, v):
@@ -426,6 +615,12 @@ class TZObj(Persistent):
             self._containerid = container.tzid
         else:
             self._containerid = None
+        global _moves_epoch
+        if len(_moves) >= _moves_max:
+            _moves.clear()
+            _moves_epoch += 1
+        tzid = getattr(self, 'tzid', None)
+        _moves[tzid] = _moves.get(tzid, 0) + 1
     def _get_container(self):
         'Getter for the container property.'
         return tzindex.get(self._containerid)
@@ -441,11 +636,55 @@ class TZObj(Persistent):
 
         '''
 
+        return tuple([tzindex.get(tzid) for tzid in self._chain()])
+
+    def _chain(self):
+        '''Return a tuple of the id numbers of the nested containers
+            this object is in, innermost first.
+
+        The chain is kept in a volatile attribute along with the number
+            of times this object and each container in the chain had
+            been moved when the chain was worked out. If any of them
+            has been moved since (or changes have been rolled back) the
+            chain is worked out again. Checking the chain only needs
+            the id numbers, so it does not load any of the containers.
+
+        If volatile_caches() is False, the chain is worked out every time.
+
+        '''
+
+        if not volatile_caches():
+            container = self.container
+            if container is None:
+                return ()
+            else:
+                return (container.tzid,) + container._chain()
+
+        cached = getattr(self, '_v_chain', None)
+        if cached is not None:
+            generation, chain, moves = cached
+            if generation == (committer.generation, _moves_epoch):
+                ok = _moves.get(self.tzid, 0) == moves[0]
+                for tzid, n in zip(chain, moves[1:]):
+                    if not ok:
+                        break
+                    ok = _moves.get(tzid, 0) == n
+                if ok:
+                    return chain
+
         container = self.container
         if container is None:
-            return tuple()
+            chain = ()
         else:
-            return (container,) + container.containers()
+            chain = (container.tzid,) + container._chain()
+
+        moves = [_moves.get(self.tzid, 0)]
+        for tzid in chain:
+            moves.append(_moves.get(tzid, 0))
+        self._v_chain = ((committer.generation, _moves_epoch), chain,
+                                                            tuple(moves))
+
+        return chain
 
     def setting(self, var, val=None):
         '''return the value of the given setting if val is None.
@@ -524,14 +763,26 @@ class TZObj(Persistent):
         An object which wants to react to a nearby action should define
             a method called near_<action> which accepts the info dict.
 
+        The methods are found when the class is created (see MetaTZObj)
+            so a near_<action> method added to an object later will not
+            be called.
+
         '''
 
-        act = info['act']
-        method_name = 'near_%s' % act
-        #print 'looking for %s on %s' % (method_name, self.name)
-        method = getattr(self, method_name, None)
-        if method is not None:
-            method(info)
+        handler = self.__class__._near_handlers.get(info['act'])
+        if handler is not None:
+            handler(self, info)
+
+    def wants(self, act):
+        '''Return True if this object might react to the given act.
+
+        Only looks at the class, so it does not load the object from
+            the database.
+
+        '''
+
+        cls = self.__class__
+        return cls._near_any or act in cls._near_acts
 
     def look(self, looker):
         '''Return a multiline message (list of strings) for a player looking
@@ -591,10 +842,13 @@ class TZObj(Persistent):
 class TZContainer(TZObj):
     'Base class for all item-containing objects (including characters).'
 
+    _near_tables = True
+    _defaults = {'_item_ids': TZIdSet}
+
     def __init__(self, name='', short='', long='', owner=None, items=None):
         TZObj.__init__(self, name, short, long, owner)
 
-        self._item_ids = PersistentList()
+        self._item_ids = TZIdSet()
         if items is not None:
             for item in items:
                 self.add(item)
@@ -637,8 +891,67 @@ class TZContainer(TZObj):
 
         TZObj.act_near(self, info)
 
+        act = info['act']
         for item in self.items():
-            item.act_near(info)
+            if item.wants(act):
+                item.act_near(info)
+
+    def wants(self, act):
+        '''Return True if this object, or anything inside of it, might
+            react to the given act.
+
+        '''
+
+        if TZObj.wants(self, act):
+            return True
+        acts = self._acts()
+        return act in acts or None in acts
+
+    def _acts(self):
+        '''Return the set of acts handled by the items inside this
+            container (and the items inside of those). The set holds
+            None if one of those items might react to any act.
+
+        The set is kept in a volatile attribute and made again after
+            anything is added to or removed from this container or one
+            of the containers inside of it, or after changes are rolled
+            back. If volatile_caches() is False, it is made every time.
+
+        '''
+
+        cached = getattr(self, '_v_acts', None)
+        if (cached is not None and cached[0] == committer.generation and
+                                                    volatile_caches()):
+            return cached[1]
+
+        acts = set()
+        for item in self.items():
+            cls = item.__class__
+            if cls._near_any:
+                acts.add(None)
+            else:
+                acts.update(cls._near_acts)
+                if isinstance(item, TZContainer):
+                    acts.update(item._acts())
+
+        self._v_acts = (committer.generation, acts)
+        return acts
+
+    def _forget_acts(self):
+        'Throw away the cached set of acts for this container.'
+
+        self._v_acts = None
+
+    def _contents_changed(self):
+        '''Something was added to or removed from this container. Throw
+            away the cached sets of acts for this container and all of
+            the containers it is in.
+
+        '''
+
+        self._forget_acts()
+        for container in self.containers():
+            container._forget_acts()
 
     def items(self):
         'Return a list of the items in this container.'
@@ -658,6 +971,107 @@ class TZContainer(TZObj):
 
         return [item.name for item in self.items()]
 
+    def _namemap(self, attr):
+        '''Return the name map for the objects with id numbers in the
+            TZIdSet held in attr (for instance '_item_ids').
+
+        The name map is a pair of dicts (names, akas) which map each
+            name to a list of the id numbers of the objects which use it,
+            in the order they were added to the container. The maps are
+            kept in a volatile attribute, built the first time they are
+            needed, and made again whenever something is added to or
+            removed from the container or any object changes its name.
+
+        Both of those are checked against values kept in the database
+            (the stamp of the TZIdSet and the serial number of the name
+            index) so changes made by other processes are seen too.
+
+        '''
+
+        ids = getattr(self, attr)
+        stamp = (ids.stamp(), nameindex.serial())
+
+        maps = getattr(self, '_v_names', None)
+        if maps is None:
+            maps = {}
+            self._v_names = maps
+
+        namemap = maps.get(attr)
+        if namemap is None or namemap[0] != stamp:
+            names = {}
+            akas = {}
+            for tzid in ids:
+                obj = tzindex.get(tzid)
+                if obj is None:
+                    continue
+                key = normalize_name(obj.name)
+                names.setdefault(key, []).append(tzid)
+                for aka in getattr(obj, 'name_aka', ()):
+                    key = normalize_name(aka)
+                    akas.setdefault(key, []).append(tzid)
+            namemap = stamp, names, akas
+            maps[attr] = namemap
+
+        return namemap[1], namemap[2]
+
+    def _names_changed(self, attr=None):
+        '''Throw away the name map for attr, or all of the name maps
+            for this container if attr is None.
+
+        '''
+
+        maps = getattr(self, '_v_names', None)
+        if maps:
+            if attr is None:
+                maps.clear()
+            else:
+                maps.pop(attr, None)
+
+    def _findname(self, attr, name, all=False, akas=True, articles=True):
+        '''Return the object with the given name from the TZIdSet held
+            in attr, or None if there is no such object.
+
+        This is the search used by itemname(), mobname(), exitname()
+            and playername(). See itemname() for the meaning of all.
+
+        If akas is True, other names (name_aka) are checked after
+            the main names. If articles is True, the name with any
+            article removed is also checked.
+
+        '''
+
+        names, akamap = self._namemap(attr)
+        key = normalize_name(name)
+
+        tzids = names.get(key, [])
+        if akas:
+            tzids = tzids + akamap.get(key, [])
+
+        result = []
+        for tzid in tzids:
+            obj = tzindex.get(tzid)
+            if obj is not None and obj not in result:
+                if not all:
+                    return obj
+                result.append(obj)
+
+        if articles:
+            for article in nameindex.articles:
+                if key.startswith(article):
+                    aname = key[len(article):]
+                    with_article = self._findname(attr, aname, all)
+                    if with_article is not None:
+                        if not all:
+                            return with_article
+                        for obj in with_article:
+                            if obj not in result:
+                                result.append(obj)
+
+        if result:
+            return result
+        else:
+            return None
+
     def itemname(self, name, all=False):
         '''Return the item with the given name if it is in this container,
             or None if no such item is in this container.
@@ -675,40 +1089,7 @@ class TZContainer(TZObj):
 
         '''
 
-        result = set()
-        for item in self.items():
-            if item.name == name:
-                if not all:
-                    return item
-                else:
-                    if item not in result:
-                        result.add(item)
-
-        for item in self.items():
-            if hasattr(item, 'name_aka'):
-                for aka in item.name_aka:
-                    if aka == name:
-                        if not all:
-                            return item
-                        else:
-                            if item not in result:
-                                result.add(item)
-
-        for article in ('a ', 'an ', 'the '):
-            if name.startswith(article):
-                l = len(article)
-                aname = name[l:]
-                with_article = self.itemname(aname, all)
-                if with_article is not None:
-                    if not all:
-                        return with_article
-                    else:
-                        result.add(with_article)
-
-        if result:
-            return list(result)
-        else:
-            return None
+        return self._findname('_item_ids', name, all)
 
     def add(self, item):
         'Put the given item in this container.'
@@ -716,6 +1097,8 @@ class TZContainer(TZObj):
         if item not in self:
             self._item_ids.append(item.tzid)
             item.container = self
+            self._names_changed('_item_ids')
+            self._contents_changed()
 
     def remove(self, item):
         '''Remove the given item from this container, if it is there.
@@ -727,6 +1110,8 @@ class TZContainer(TZObj):
         if item in self:
             self._item_ids.remove(item.tzid)
             item.container = None
+            self._names_changed('_item_ids')
+            self._contents_changed()
 
     def has_inside(self, item):
         '''Check for item in this container, including inside of
@@ -750,6 +1135,12 @@ class Character(TZContainer):
     health = int_attr('health')
     strength = int_attr('strength')
     settings = ['home'] + stats_list
+    _defaults = {'_wearing_ids': TZIdSet}
+
+    # roles ('wizard', 'admin') given to this character. Kept in step
+    #   with the lists in dbroot by wizard.add() and admin.add() so that
+    #   checking a role does not need to search those lists.
+    _roles = frozenset()
 
     def __init__(self, name='', short='', long=''):
         self._rid = None
@@ -761,7 +1152,7 @@ class Character(TZContainer):
 
         self._set_default_stats()
 
-        self._wearing_ids = PersistentList()
+        self._wearing_ids = TZIdSet()
 
         self.awake = True
         self.standing = True
@@ -794,10 +1185,7 @@ Character (%s): %s
             room.action(dict(act='leave', actor=self, tox=x))
             self.move(dest)
 
-            backx = None
-            for backx in dest.exits():
-                if backx.destination == room:
-                    break
+            backx = dest.exitto(room)
             dest.action(dict(act='arrive', actor=self, fromx=backx))
 
         return r
@@ -815,6 +1203,21 @@ Character (%s): %s
         if self.can_see(obj):
             return obj.look(self)
 
+    def has_role(self, role):
+        'Return True if this character has been given the named role.'
+
+        return role in self._roles
+
+    def add_role(self, role):
+        'Give this character the named role.'
+
+        self._roles = self._roles.union([role])
+
+    def remove_role(self, role):
+        'Take the named role away from this character.'
+
+        self._roles = self._roles.difference([role])
+
     def can_see(self, obj):
         '''return True if character can see the given object.
         '''
@@ -1025,15 +1428,13 @@ Character (%s): %s
     def _follow(self, leaver, x):
         'Follow along if this character is following someone who left.'
 
+        savepoint = committer.savepoint()
         try:
             if leaver not in self.room:
                 self.go(x)
-        except:
-            #print 'Character._follow ABORT'
-            abort()
-        else:
-            #print 'Character._follow COMMIT'
-            commit()
+        except Exception, e:
+            #print 'Character._follow ROLLBACK'
+            savepoint.rollback(e)
 
     def teleport(self, destination=None):
         destination = destination or self.home
@@ -1297,14 +1698,135 @@ def register_plugin(cls):
         print 'plugin', name, 'registered.'
 
 
+class UpgradePlan(object):
+    '''What needs to be done to bring an object of one class up to
+        date with the current class definition.
+
+    The plan is worked out once for each class from what the class
+        declares. No object of the class is created, since creating
+        one can have effects outside of the database (a mob puts
+        itself on the scheduler, a Zoo fills itself with mobs...).
+
+    The plan has three parts:
+
+        settings    the names in the settings list of the class. Any
+                        which are missing from the settings list of
+                        the object are added.
+        remembered  setting values given in the class statement (see
+                        MetaTZObj). For a list, entries missing from
+                        the list of the object are added. Any other
+                        value is only set if the object has no value
+                        of its own. Values are set with setting() so
+                        that other names (name_aka) also go in the
+                        name index.
+        defaults    the _defaults of the class and its bases, which
+                        map the name of an attribute every object
+                        must have to a function returning a new value
+                        for it. Only set if the object does not have
+                        the attribute.
+
+    An upgrade only ever adds. Values the object already has are never
+        changed or removed.
+
+    '''
+
+    def __init__(self, cls):
+        self.cls = cls
+
+        self.settings = list(cls.settings)
+
+        remembered = getattr(cls, '_remember_settings', {}).items()
+        remembered.sort()
+        self.remembered = remembered
+
+        defaults = {}
+        for klass in reversed(cls.__mro__):
+            defaults.update(klass.__dict__.get('_defaults', {}))
+        defaults = defaults.items()
+        defaults.sort()
+        self.defaults = defaults
+
+        import hashlib
+        sig = (sorted(self.settings), self.remembered,
+                    [attr for attr, factory in self.defaults])
+        self.schema = hashlib.md5(repr(sig)).hexdigest()
+
+    def current(self, obj):
+        'Return True if obj has already been upgraded with this plan.'
+
+        return getattr(obj, '_schema', None) == self.schema
+
+    def apply(self, obj):
+        'Bring obj up to date.'
+
+        obj._p_activate()
+        state = obj.__dict__
+
+        settings = state.get('settings')
+        if settings is None:
+            obj.settings = PersistentList(self.settings)
+        else:
+            missing = [stg for stg in self.settings if stg not in settings]
+            if missing:
+                settings.extend(missing)
+                if isinstance(settings, list):
+                    obj._p_changed = True
+
+        for stg, val in self.remembered:
+            if type(val) == type([]):
+                current = obj.setting(stg) or []
+                for v in val:
+                    if v not in current:
+                        obj.setting(stg, v)
+            elif stg not in state and '_%s' % stg not in state:
+                obj.setting(stg, val)
+
+        for attr, factory in self.defaults:
+            if attr not in state:
+                setattr(obj, attr, factory())
+
+        obj._schema = self.schema
+
+
+_plans = {}
+def upgrade_plan(cls):
+    'Return the UpgradePlan for the given class, making it if needed.'
+
+    plan = _plans.get(cls)
+    if plan is None:
+        plan = UpgradePlan(cls)
+        _plans[cls] = plan
+    return plan
+
+
 def upgrade(obj, newcls=None):
     '''Use this function to upgrade objects any time they need
         to change (ie. if it needs to grow a new property.)
 
+    The object is changed in place and returned.
+
     If the upgrade involves converting to an entirely new class,
         pass in the class object as newcls. This was used, for
         example, when moving the Exit class from the rooms module
-        to the new exits module.
+        to the new exits module. In that case a new object replaces
+        the old one and the new object is returned.
+
+    Does not commit.
+
+    '''
+
+    if newcls is not None and newcls is not obj.__class__:
+        return replace(obj, newcls)
+
+    plan = upgrade_plan(obj.__class__)
+    if not plan.current(obj):
+        plan.apply(obj)
+    return obj
+
+
+def replace(obj, newcls):
+    '''Replace obj with a new object of class newcls, copying over
+        as much of the state of obj as possible.
 
     '''
 
@@ -1316,49 +1838,52 @@ def upgrade(obj, newcls=None):
 
     import types
 
-    updatedname = obj.name+'____updated____'
-    if newcls is None:
-        newcls = obj.__class__
-    updated = newcls(updatedname)
-    module = __import__(updated.__module__)
+    global _created
 
+    updatedname = obj.name+'____updated____'
+    _created = []
     try:
-        module.remove(updated)
-    except KeyError:
-        pass
-    tzindex.remove(updated)
+        updated = newcls(updatedname)
+    finally:
+        created = _created
+        _created = None
+    module = __import__(updated.__module__)
 
     # Some objects create other objects during their
     #   creation. In order to make sure that we get rid
     #   of the unwanted duplicates, set the _upgraded
-    #   flag on the updated version. Anything that does
-    #   not have this flag will later be deleted.
+    #   flag on the updated version. Anything else created
+    #   along with it that does not have this flag will
+    #   later be removed.
     #
     # This means that if a new update to an object (the
     #   reason for running the upgrade on the database)
     #   involves the creation of an object that was not
     #   created before, that new addition should be
     #   marked with "_upgraded = True" manually before
-    #   running the upgrade, or else it will be deleted.
+    #   running the upgrade, or else it will be removed.
     updated._upgraded = True
 
+    try:
+        module.remove(updated)
+    except KeyError:
+        pass
+    nameindex.remove(updated)
+    tzindex.remove(updated)
 
     for attr in dir(updated):
         if attr.startswith('__'):
             pass
-            #print '    ignoring'
         elif attr.startswith('_p_'):
             pass
-            #print '    ignoring'
-        elif attr == 'tzid':
-            print '        tzid'
-        elif attr == 'name':
-            print '        name'
+        elif attr in ('tzid', 'name'):
+            pass
         else:
             oldattr = getattr(obj, attr, na)
             oldattrtype = type(oldattr)
             newattr = getattr(updated, attr, na)
-            if attr in ['_exit_ids', '_mob_ids', '_item_ids']:
+            if attr in ['_exit_ids', '_mob_ids', '_item_ids',
+                            '_player_ids', '_wearing_ids']:
                 newattr = None
             newattrtype = type(newattr)
 
@@ -1367,40 +1892,30 @@ def upgrade(obj, newcls=None):
 
             if newattrtype == types.MethodType:
                 pass
-                #print '    method', attr
             elif newattrtype in listtypes and newattrtype==oldattrtype:
-                print '        extending list', attr
-                print '        oldattr', oldattr
-                print '        newattr', newattr
                 for val in oldattr:
-                    print '         checking', val
                     if val not in newattr:
-                        print '             adding', val
                         newattr.append(val)
             elif newattrtype in dicttypes and newattrtype==oldattrtype:
-                print '        extending dict', attr
                 for var in oldattr:
                     if var not in newattr:
                         newattr[var] = oldattr[var]
             elif oldattr is not na:
                 if newattr is None or newattrtype==oldattrtype:
-                    print '        copying', attr
                     try:
                         setattr(updated, attr, oldattr)
                     except AttributeError:
-                        print '        ...must be a property.'
+                        # must be a property
+                        pass
                 else:
                     print '        ', attr, 'changed type'
-            else:
-                print '        new attribute', attr
 
     if module.get(obj.tzid):
-        print 'replacing in module index'
         addtomodindex = True
         module.remove(obj)
     else:
-        print 'NOT replacing in module index'
         addtomodindex = False
+    nameindex.remove(obj)
     tzindex.remove(obj)
 
     updated.tzid = obj.tzid
@@ -1412,31 +1927,87 @@ def upgrade(obj, newcls=None):
     if addtomodindex:
         module.add(updated)
     tzindex.add(updated)
+    nameindex.add(updated)
+
+    for extraid in created:
+        extra = tzindex.get(extraid)
+        if extra is None or extra is updated:
+            continue
+        elif getattr(extra, '_upgraded', False):
+            del extra._upgraded
+        else:
+            print '    removing duplicate', extra.name
+            try:
+                class_mod(extra).remove(extra)
+            except KeyError:
+                pass
+            nameindex.remove(extra)
+            tzindex.remove(extra)
 
-    commit()
+    del updated._upgraded
 
     return updated
 
 
-def upgradeall():
-    'Upgrade every object in the database.'
+def upgradeall(batch=None):
+    '''Upgrade every object in the database.
+
+    Objects are upgraded in order of tzid and committed batch at a time
+        (conf.upgrade_batch by default). The last tzid committed is kept
+        in dbroot['_upgrade'] so that if the upgrade is interrupted,
+        running it again carries on where it stopped. Objects which are
+        already up to date with their class are skipped.
+
+    '''
+
+    import time
+
+    if batch is None:
+        batch = conf.upgrade_batch
 
-    for obj in tzindex.ls():
-        upgrade(obj)
+    _plans.clear()
 
-    for obj in tzindex.ls():
-        print 'checking for duplicate', obj.name,
-        upgraded = getattr(obj, '_upgraded', False)
-        if not upgraded:
-            print 'dup'
-            tzindex.remove(obj)
-            module = __import__(obj.__module__)
-            if module.get(obj.tzid):
-                module.remove(obj)
+    idx = tzindex.idx()
+    total = len(idx)
+
+    checkpoint = dbroot.get('_upgrade')
+    if checkpoint is None:
+        checkpoint = PersistentDict(last=-1, done=0, skipped=0)
+        dbroot['_upgrade'] = checkpoint
+        commit()
+    else:
+        print 'resuming upgrade after', checkpoint['last']
+
+    if hasattr(idx, 'minKey'):
+        tzids = idx.keys(checkpoint['last']+1)
+    else:
+        # before database version 6 the index is a PersistentDict
+        tzids = [tzid for tzid in idx.keys() if tzid > checkpoint['last']]
+        tzids.sort()
+
+    start = time.time()
+    n = 0
+    for tzid in tzids:
+        obj = idx[tzid]
+        plan = upgrade_plan(obj.__class__)
+        if plan.current(obj):
+            checkpoint['skipped'] += 1
         else:
-            print 'unique'
-            del(obj._upgraded)
+            plan.apply(obj)
+            checkpoint['done'] += 1
+        checkpoint['last'] = tzid
 
+        n += 1
+        if n % batch == 0:
+            commit()
+            zodb.conn.cacheGC()
+            count = checkpoint['done'] + checkpoint['skipped']
+            print 'upgraded %s of %s (%s skipped) %.1fs' % (count, total,
+                                checkpoint['skipped'], time.time()-start)
+
+    print 'upgraded %s, skipped %s, %s classes' % (checkpoint['done'],
+                                    checkpoint['skipped'], len(_plans))
+    del dbroot['_upgrade']
     commit()
 
 
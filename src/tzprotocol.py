@@ -78,11 +78,14 @@ from twisted.internet import reactor
 
 import conf
 
-from db import TZODB, TZIndex
+from ZODB.POSException import ConflictError
+
+from db import TZODB, TZIndex, TZCommitter
 commit = TZODB().commit
 abort = TZODB().abort
 
 tzindex = TZIndex()
+committer = TZCommitter()
 
 import colors
 
@@ -107,6 +110,9 @@ class TZ(basic.LineReceiver):
         zodb = TZODB()
         self.dbroot = zodb.root
         self.login_failures = 0
+        self.busy = False # a line is waiting for its transaction to finish
+        self.held = [] # lines received while busy
+        self.run_again = None # seconds until the last line is run again
 
     def connectionMade(self):
         'A new connection. Send out the MOTD.'
@@ -156,10 +162,7 @@ class TZ(basic.LineReceiver):
                 try:
                     # if this doesn't fail, then that player is still logging out...
                     print self.factory._player_protocols[player_name] 
-                    try:
-                        reactor.callLater(0.1, self.login, r)
-                    except:
-                        print 'tzprotocol :: login :: callLater :: fail'
+                    self.run_again = 0.1
                 except:
                     if player.check_password(pwtext):
                     #if True:
@@ -171,8 +174,8 @@ class TZ(basic.LineReceiver):
                         self.factory._player_protocols[player_name] = self
 
                         wizard.cmd_teleport(self, {})
-                        reactor.callLater(0.6, actions.cmd_look, self,
-                                            dict(verb='look'))
+                        committer.after_commit(reactor.callLater, 0.6,
+                                    actions.cmd_look, self, dict(verb='look'))
                         print 'player', player.name, 'logged in'
                     else:
                         self.simessage('Incorrect user name or password.')
@@ -180,7 +183,7 @@ class TZ(basic.LineReceiver):
                         self.login_failures += 1
 
             if self.login_failures >= 3:
-                self.transport.loseConnection()
+                self.disconnect()
 
     def create(self, r):
         'Create a new account.'
@@ -230,7 +233,9 @@ class TZ(basic.LineReceiver):
 
         print "Lost a client!"
         self.factory.clients.remove(self)
+        self.held = []
 
+        savepoint = committer.savepoint()
         try:
             room = self.room
             room.action(dict(act='quit', actor=self.player))
@@ -238,12 +243,9 @@ class TZ(basic.LineReceiver):
             self.room.rmplayer(self.player)
             self.player._rid = None
             self.player.logged_in = False
-        except:
-            #print 'TZ.connectionLost ABORT'
-            abort()
-        else:
-            #print 'TZ.connectionLost COMMIT'
-            commit()
+        except Exception, e:
+            #print 'TZ.connectionLost ROLLBACK'
+            savepoint.rollback(e)
 
         if hasattr(self, 'player'):
             del self.factory._player_protocols[self.player.name]
@@ -255,13 +257,94 @@ class TZ(basic.LineReceiver):
             the line is sent to the parser, then dispatched to the
             proper command section if possible.
 
-        Each line received begins a new database transaction, and
-            only if the entire command runs without errors will the
-            transaction be committed. Any problems will result in a
-            rollback so that the database will always be consistent.
+        Each line received runs in its own savepoint, and only if the
+            entire command runs without errors will its changes be kept.
+            Any problems will result in a rollback of the changes made
+            by the command so that the database will always be
+            consistent. Kept changes are committed by the TZCommitter
+            along with everything else done in this pass through the
+            reactor loop.
+
+        If the transaction fails because of a ConflictError with another
+            process using the database, the line is run again. Lines are
+            run one at a time: any line received before the transaction
+            of the one before it is finished (committed, or aborted and
+            run again) is held until then, so the lines from one client
+            always run in the order they were sent.
+
+        '''
+
+        if self.busy:
+            self.held.append(line)
+        else:
+            self._line(line)
+
+    def _get_session(self):
+        '''Return the state of this connection which is not kept in the
+            database, for _set_session().
 
         '''
 
+        return (self.logged_in, getattr(self, 'player', None), self.room)
+
+    def _set_session(self, session):
+        '''Put the connection back in the state returned by
+            _get_session(), after the changes made by a line have been
+            thrown away.
+
+        '''
+
+        logged_in, player, room = session
+        current = getattr(self, 'player', None)
+        if current is not None and current is not player:
+            if self.factory._player_protocols.get(current.name) is self:
+                del self.factory._player_protocols[current.name]
+        self.logged_in = logged_in
+        self.run_again = None
+        if player is not None:
+            self.player = player
+        elif current is not None:
+            del self.player
+        self.room = room
+
+    def _line_done(self, line=None):
+        '''The transaction of the last line is finished. Run any held lines.
+
+        If the last line asked to be run again (by setting run_again)
+            it is held ahead of the others, and they all wait until
+            it is time to run it.
+
+        '''
+
+        self.busy = False
+        if line is not None and self.run_again is not None:
+            delay = self.run_again
+            self.run_again = None
+            self.busy = True
+            self.held.insert(0, line)
+            reactor.callLater(delay, self._line_done)
+            return
+        while self.held and not self.busy:
+            self._line(self.held.pop(0))
+
+    def _line_aborted(self, session):
+        '''The transaction of the last line was aborted. Undo the changes
+            to the connection, and unless the line will be run again,
+            go on with any held lines. If the line had too many
+            conflicts to be run again, tell the player.
+
+        '''
+
+        self._set_session(session)
+        if committer.gave_up(self._line):
+            self.simessage('The server is busy. Please try again.')
+        if not committer.will_retry(self._line):
+            self._line_done()
+
+    def _line(self, line):
+        'Run one line of input. See lineReceived().'
+
+        rawline = line
         try:
             line = line.decode('utf-8')
         except UnicodeDecodeError:
@@ -272,9 +355,15 @@ class TZ(basic.LineReceiver):
         if not line:
             return
 
+        self.busy = True
+        session = self._get_session()
+        committer.retryable(self._line, rawline)
+        committer.after_commit(self._line_done, rawline)
+        committer.after_abort(self._line_aborted, session)
+        savepoint = committer.savepoint()
         try:
             if not self.logged_in and line=='quit':
-                self.transport.loseConnection()
+                self.disconnect()
             elif not self.logged_in and line.startswith('login '):
                 self.login(line[6:])
 
@@ -290,7 +379,7 @@ class TZ(basic.LineReceiver):
             elif self.room is None:
                 # log in not complete yet. Try waiting a bit and sending
                 #   this command through again later.
-                reactor.callLater(0.6, self.lineReceived, line)
+                self.run_again = 0.6
                 return
 
             else:
@@ -347,9 +436,16 @@ class TZ(basic.LineReceiver):
 
                 self.dispatch(section, cmd, rest)
 
+        except ConflictError, e:
+            # the whole transaction will be aborted and this line will
+            #   be run again in a new transaction.
+            savepoint.rollback(e)
+            print 'lineReceived CONFLICT'
+
         except Exception, e:
-            abort()
-            print 'lineReceived ABORTING TRANSACTION'
+            savepoint.rollback(e)
+            self._set_session(session)
+            print 'lineReceived ROLLING BACK COMMAND'
             if conf.debug:
                 self.simessage('Debug')
                 self.simlmessage(e)
@@ -368,10 +464,6 @@ class TZ(basic.LineReceiver):
                 print 'Cannot recover from error.'
                 raise
 
-        else:
-            #print 'lineReceived COMMIT'
-            commit()
-
 
     def dispatch(self, section, cmd, rest):
         '''Call the appropriate function if possible.
@@ -452,13 +544,17 @@ class TZ(basic.LineReceiver):
                 self.message('I have no idea.')
             return
 
+        savepoint = committer.savepoint()
         try:
             if rest:
                 func(self, rest)
             else:
                 func(self)
-        except share.Deprecated:
-            abort()
+        except ConflictError, e:
+            savepoint.rollback(e)
+            raise
+        except share.Deprecated, e:
+            savepoint.rollback(e)
             import traceback
             traceback.print_exc()
             self.message('Attempting to use deprecated code.')
@@ -477,7 +573,7 @@ class TZ(basic.LineReceiver):
                 self.simessage('Debug')
                 self.simlmessage(e)
         except Exception, e:
-            abort()
+            savepoint.rollback(e)
             self.message('I am having trouble with that command.')
             self.message(u'Try "%shelp %s" for more information.' % (
                                                                 first, cmd))
@@ -499,7 +595,7 @@ class TZ(basic.LineReceiver):
             msg = msg.encode('utf-8')
         except UnicodeDecodeError:
             msg = '??UDE??'
-        self.transport.write(msg + '\r\n')
+        self.write(msg + '\r\n')
 
     def message(self, *args, **kw):
         'Send line to client, possibly indented and colorized.'
@@ -536,9 +632,28 @@ class TZ(basic.LineReceiver):
         if wrapped:
             for line in wrapped:
                 line = line.encode('utf-8')
-                self.transport.write(' '*indent + line + '\r\n')
+                self.write(' '*indent + line + '\r\n')
         else:
-            self.transport.write('\r\n')
+            self.write('\r\n')
+
+    def write(self, data):
+        '''Queue data to be sent to the client.
+
+        Output is held until the current transaction is committed, then
+            all of it is sent in a single write. Output from a command
+            which is rolled back is never sent, so a command which is
+            run again after a ConflictError does not send its output
+            twice.
+
+        '''
+
+        committer.write(self, data)
+
+    def disconnect(self):
+        'Close the connection after any queued output has been sent.'
+
+        committer.after_commit(self.transport.loseConnection)
+        committer.after_abort(self.transport.loseConnection)
 
     def mlmessage(self, lines, indent=0, color=True):
         'Send a multi-line message.'
@@ -673,5 +788,5 @@ class TZ(basic.LineReceiver):
         if player.logged_in:
             client = cls.playerclient(player)
             if client is not None:
-                client.transport.loseConnection()
+                client.disconnect()
             player.logged_in = False
@@ -52,12 +52,8 @@ tzindex = TZIndex()
 def verify(player):
     'return True if player is a wizard, False otherwise'
 
-    if player.name in dbroot['wizard']:
-        return True
-    elif admin.verify(player):
-        return True
-    else:
-        return False
+    roles = getattr(player, '_roles', ())
+    return 'wizard' in roles or 'admin' in roles
 
 
 def add(player):
@@ -65,6 +61,7 @@ def add(player):
 
     if not verify(player):
         dbroot['wizard'].append(player.name)
+        player.add_role('wizard')
 
 
 def remove(player):
@@ -72,6 +69,7 @@ def remove(player):
 
     if player.name in dbroot['wizard']:
         dbroot['wizard'].remove(player.name)
+    player.remove_role('wizard')
 
 
 def cmd_info(s, r):
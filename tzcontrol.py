@@ -106,7 +106,7 @@ except ImportError:
 
 
 def verify_config():
-    varstrings = ['python:-', 'python_version:ver', 'twistd:-', 'twistdlog:-', 'twistdpid:-', 'tztac:-', 'tzcontrol:-', 'src:d', 'plugins:d', 'dbmod:-', 'dbdir:d', 'datafs:-', 'backupdir:d', 'svn:-', 'port:int', 'local_only:bool', 'home_id:int', 'web:bool', 'web_local_only:bool', 'enable_cmd_py:bool']
+    varstrings = ['python:-', 'python_version:ver', 'twistd:-', 'twistdlog:-', 'twistdpid:-', 'tztac:-', 'tzcontrol:-', 'src:d', 'plugins:d', 'dbmod:-', 'dbdir:d', 'datafs:-', 'backupdir:d', 'storage:storage', 'conflict_retries:int', 'cache_size:int', 'cache_size_bytes:int', 'pool_size:int', 'pack_interval:int', 'pack_days:int', 'tzid_block:int', 'upgrade_batch:int', 'scheduler_slots:int', 'scheduler_horizon:int', 'scheduler_load:int', 'scheduler_rescan:int', 'sim_shed_priority:int', 'sim_shed_delay:int', 'sim_shed_max:int', 'spread_max_rooms:int', 'aoi_radius:int', 'aoi_catch_up:int', 'svn:-', 'port:int', 'local_only:bool', 'home_id:int', 'web:bool', 'web_local_only:bool', 'enable_cmd_py:bool']
 
     for varstring in varstrings:
         varname, vartype = varstring.split(':')
@@ -169,6 +169,17 @@ def verify_config():
             else:
                 print '!! must give a boolean value'
 
+        elif vartype == 'storage':
+            if val == 'file':
+                print 'ok'
+            elif val == 'zeo':
+                if os.path.exists(conf.runzeo):
+                    print 'ok'
+                else:
+                    print '!! runzeo not found at', conf.runzeo
+            else:
+                print "!! must be 'file' or 'zeo'"
+
         elif vartype == 'ver':
             try:
                 t1, t2 = val.split('.')
@@ -204,11 +215,62 @@ def delay():
 
     time.sleep(conf.restart_delay)
 
+def zeopid():
+    'Return the pid of the running ZEO server.'
+
+    try:
+        return int(file(conf.zeopid).read())
+    except:
+        return None
+
+def zeostart():
+    'Start the ZEO server if the database is shared through ZEO.'
+
+    if conf.storage != 'zeo' or zeopid() is not None:
+        return
+
+    from subprocess import Popen, STDOUT
+    host, port = conf.zeo_address
+    cmd = [conf.runzeo, '-a', '%s:%s' % (host, port), '-f', conf.datafs]
+    log = file(conf.zeolog, 'a')
+    p = Popen(cmd, stdout=log, stderr=STDOUT)
+    file(conf.zeopid, 'w').write(str(p.pid))
+
+    # give the ZEO server a moment to start listening
+    time.sleep(2)
+    print 'ZEO server started on port', port
+
+def zeoshutdown():
+    'Stop the ZEO server if it is running.'
+
+    p = zeopid()
+    if p is not None:
+        try:
+            os.kill(p, 15)
+        except OSError:
+            print 'ZEO server already shut down.'
+        try:
+            os.remove(conf.zeopid)
+        except OSError:
+            pass
+
+def wait_for_exit(p, timeout=30):
+    'Wait until the process with the given pid has exited.'
+
+    for i in range(timeout * 10):
+        try:
+            os.kill(p, 0)
+        except OSError:
+            return
+        time.sleep(0.1)
+
 def start():
     'Try to start the server if it is not already running.'
 
     p = pid()
     if p is None:
+        zeostart()
+
         system = platform.system()
 
         if system != 'Linux':
@@ -253,6 +315,12 @@ def shutdown():
         except OSError:
             print 'Server already shut down.'
             rmpid()
+        else:
+            # let the server commit its last changes before stopping
+            #   the ZEO server.
+            wait_for_exit(p)
+
+    zeoshutdown()
 
     dbunlock()
 
@@ -294,6 +362,7 @@ def dbinit():
     'Remove old database and start from a complete fresh start.'
 
     dbclean()
+    zeostart()
     cmd = '%s %s init' % (conf.python, conf.dbmod)
     os.system(cmd)
 
@@ -352,24 +421,80 @@ def pack(fname):
     cmd = '%s %s pack %s' % (conf.python, conf.dbmod, fname)
     os.system(cmd)
 
+def exportdb(fname):
+    '''Write all of the objects in the database to the given file.
+
+    With conf.storage = 'file' the server must be shut down first.
+
+    '''
+
+    zeostart()
+    cmd = '%s %s export %s' % (conf.python, conf.dbmod, fname)
+    os.system(cmd)
+
+def importdb(fname):
+    '''Shut down the server and replace the database with the objects
+        in the given export file.
+
+    '''
+
+    fname = os.path.abspath(fname)
+    if not os.path.exists(fname):
+        print 'No such file:', fname
+        return
+
+    shutdown()
+    delay()
+    dbclean()
+    zeostart()
+    cmd = '%s %s import %s' % (conf.python, conf.dbmod, fname)
+    os.system(cmd)
+
+def incbackup():
+    'Take an incremental backup of the database.'
+
+    src = os.path.abspath(conf.src)
+    sys.path.append(src)
+
+    import backup
+    name = backup.backup()
+    if name is None:
+        print 'Nothing has changed since the last backup.'
+    else:
+        print 'backup', name, 'saved in', conf.incbackupdir
+
 def rollbackfile(fname):
     '''Check for existence of given rollback file.
 
     Defaults to most recent backup file if None given.
 
+    Incremental backups (see src/backup.py) are given by the name of
+        the file in the backup chain to roll back to.
+
     '''
 
+    src = os.path.abspath(conf.src)
+    sys.path.append(src)
+    import backup
+
     if fname is None:
         backups = os.listdir(conf.backupdir)
         backups = [f for f in backups if not f.startswith('.')]
-        backups.sort()
+        backups = ['%s/%s' % (conf.backupdir, f) for f in backups]
+        incbackups = backup.ls()
+        if incbackups:
+            backups.append('%s/%s' % (conf.incbackupdir, incbackups[-1]))
         if backups:
-            fname = backups[-1]
+            backups.sort(key=os.path.getmtime)
+            return backups[-1]
         else:
             print 'ERROR'
             print 'No backup files exist.'
             return False
 
+    if backup.isbackup(fname):
+        return '%s/%s' % (conf.incbackupdir, os.path.basename(fname))
+
     rbf = '%s/%s' % (conf.backupdir, fname)
 
     if not os.path.exists(rbf):
@@ -392,7 +517,12 @@ def rollback(rbf):
         delay()
         dbclean()
         print 'Restoring backup', rbf
-        shutil.copyfile(rbf, conf.datafs)
+        import backup
+        if backup.isbackup(rbf):
+            # replay the full backup and the deltas up to rbf
+            backup.restore(rbf, conf.datafs)
+        else:
+            shutil.copyfile(rbf, conf.datafs)
         start()
         return True
     else:
@@ -410,6 +540,8 @@ def upgradedb():
     src = os.path.abspath(conf.src)
     sys.path.append(src)
 
+    zeostart()
+
     import share
     share.upgradeall()
 
@@ -478,6 +610,13 @@ def main():
         parser.add_option('-b', '--backup', dest='backup',
             action="store_true",
             help='Back up the database.')
+        parser.add_option('-i', '--incbackup', dest='incbackup',
+            action="store_true",
+            help='Take an incremental backup of the database.')
+        parser.add_option('-x', '--export', dest='export',
+            help='Export all objects in the database to the given file.')
+        parser.add_option('-X', '--import', dest='import_',
+            help='Replace the database with the objects in the given export file.')
         parser.add_option('-W', '--world', dest='world',
             action="store_true",
             help='Save depopulated DB for world distribution.')
@@ -522,6 +661,12 @@ def main():
             fresh()
         elif options.backup:
             backup()
+        elif options.incbackup:
+            incbackup()
+        elif options.export:
+            exportdb(options.export)
+        elif options.import_:
+            importdb(options.import_)
         elif options.world:
             world()
         elif options.rollback: